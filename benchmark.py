@@ -0,0 +1,311 @@
+#benchmark suite for the processing and prediction stages
+#the real data files are too big for the repo, so this generates synthetic inputs of the same formats instead:
+#IGRA sounding text, NCEI global-hourly CSV (with AW/MW weather codes) and a small WRF-like NetCDF file.
+#every stage runs in its own fresh process, so the peak memory reported is that stage's alone. The results
+#(seconds, rows/s, peak RSS) are compared against a stored baseline and slowdowns over REGRESSION_TOLERANCE are flagged
+#runs offline, everything is written under workdir
+
+import os
+import csv
+import json
+import time
+import random
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import read_sounding_obs as rso
+import read_integrated_sfcobs as ris
+import combine_snd_sfc as css
+from table_io import write_table
+
+#a stage counts as a regression if it's this much slower (or uses this much more memory) than the baseline
+REGRESSION_TOLERANCE = 0.25
+#input sizes at scale 1, everything grows linearly with scale
+SOUNDINGS_PER_SCALE = 20000
+SURFACE_OBS_PER_SCALE = 200000
+TRAINING_ROWS_PER_SCALE = 200000
+PREDICT_ROWS_PER_SCALE = 1000000
+WRF_POINTS_PER_SCALE = 200 * 200
+WRF_LEVELS = 40
+
+FEATURES = ['sfc_t', 'sfc_td', 't925', 'td925', 't850', 'td850']
+
+#----- synthetic inputs -----
+
+#IGRA data lines are fixed width, see the format description in read_sounding_obs.py
+def _igra_level(r, pressure):
+    def field(value, width, flag=''):
+        return str(value).rjust(width) + flag
+    flag = lambda: r.choice(' AB')
+    temp = r.randint(-600, 300) if r.random() > 0.05 else -9999
+    rh = r.randint(50, 1000) if r.random() > 0.3 else -9999
+    dpdp = r.randint(0, 300) if r.random() > 0.3 else -9999
+    return (str(r.choice([10, 20, 21, 30, 31])) + ' ' + field(r.randint(0, 9999), 5) + ' ' + field(pressure, 6, flag())
+            + field(r.randint(100, 5000), 5, flag()) + field(temp, 5, flag()) + field(rh, 5) + ' ' + field(dpdp, 5)
+            + ' ' + field(r.randint(0, 360), 5) + ' ' + field(r.randint(0, 500), 5))
+
+#twice daily soundings from 1990 on, each with 10-40 levels from the surface up to ~300 hPa
+def make_igra(path, n_soundings, seed=0, station="USM00072645"):
+    r = random.Random(seed)
+    start = datetime(1990, 1, 1)
+    with open(path, 'w') as file:
+        for k in range(n_soundings):
+            date = start + timedelta(hours=12 * k)
+            n_levels = r.randint(10, 40)
+            file.write(f"#{station} {date.year:4d} {date.month:02d} {date.day:02d} {date.hour:02d} {date.hour:02d}00 "
+                       f"{n_levels:4d} ncdc-gts ncdc-gts  445000  -880000\n")
+            pressure = r.randint(97000, 101000)
+            for _ in range(n_levels):
+                file.write(_igra_level(r, pressure) + "\n")
+                pressure -= r.randint(500, 2500)
+
+GLOBAL_HOURLY_COLUMNS = ["STATION", "DATE", "SOURCE", "LATITUDE", "LONGITUDE", "ELEVATION", "NAME", "REPORT_TYPE", "CALL_SIGN",
+                         "QUALITY_CONTROL", "WND", "CIG", "VIS", "TMP", "DEW", "SLP", "AA1", "AW1", "AW2", "AW3", "AW4",
+                         "MW1", "MW2", "MW3", "MW4", "MW5", "MW6", "REM"]
+
+#surface obs every 20-60 minutes from 1990 on, some with present weather codes (AW/MW) and some missing temperatures
+def make_global_hourly(path, n_obs, seed=0, station="72645014898"):
+    r = random.Random(seed)
+    date = datetime(1990, 1, 1)
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        writer.writerow(GLOBAL_HOURLY_COLUMNS)
+        for _ in range(n_obs):
+            date += timedelta(minutes=r.choice([20, 40, 60, 60]))
+            row = dict.fromkeys(GLOBAL_HOURLY_COLUMNS, "")
+            row.update(STATION=station, DATE=date.strftime("%Y-%m-%dT%H:%M:%S"), SOURCE="4", LATITUDE="44.47", LONGITUDE="-88.13",
+                       NAME="GREEN BAY, WI US", REPORT_TYPE=r.choice(["FM-15", "FM-15", "FM-16", "FM-12", "SOD  "]),
+                       TMP=f"{r.randint(-300, 350):+05d},1" if r.random() > 0.02 else "+9999,9",
+                       DEW=f"{r.randint(-300, 250):+05d},1" if r.random() > 0.02 else "+9999,9", REM="MET")
+            for column in ("AW1", "AW2"):
+                if r.random() < 0.3:
+                    row[column] = f"{r.choice([11, 21, 22, 40, 41, 51, 61, 62, 67, 71, 72, 73, 75, 89]):02d},1"
+            for column in ("MW1", "MW2"):
+                if r.random() < 0.3:
+                    row[column] = f"{r.choice([10, 21, 22, 51, 61, 63, 66, 68, 71, 73, 79, 85]):02d},1"
+            writer.writerow([row[c] for c in GLOBAL_HOURLY_COLUMNS])
+
+#training table like combine_snd_sfc.py's output, labelled with a rough "is the column below freezing" rule plus noise
+def make_training_table(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    sfc_t = rng.normal(2, 6, n_rows)
+    t925 = sfc_t - rng.normal(4, 3, n_rows)
+    t850 = t925 - rng.normal(5, 3, n_rows)
+    table = pd.DataFrame({'date': pd.Timestamp('1990-01-01') + pd.to_timedelta(np.arange(n_rows) * 12, unit='h'),
+                          'sfc_t': sfc_t, 'sfc_td': sfc_t - rng.gamma(2, 1.5, n_rows),
+                          't925': t925, 'td925': t925 - rng.gamma(2, 2, n_rows),
+                          't850': t850, 'td850': t850 - rng.gamma(2, 3, n_rows)})
+    for column in FEATURES:
+        table[column] = table[column].round(1)
+    warmest = np.maximum(np.maximum(sfc_t, t925), t850)
+    table['precip_type'] = (warmest + rng.normal(0, 1.5, n_rows) < 1).astype(int)
+    return table
+
+#WRF-like output on a ny x nx grid around the upper midwest with WRF_LEVELS eta levels. Only the variables the
+#prediction scripts use are written: P/PB (Pa), T (perturbation potential temperature, K), QVAPOR, T2, Q2, PSFC, XLAT, XLONG
+def make_wrf(path, ny, nx, nz=WRF_LEVELS, seed=0):
+    from netCDF4 import Dataset
+    rng = np.random.default_rng(seed)
+    lat = np.linspace(38, 51, ny)[:, None] * np.ones((1, nx))
+    lon = np.ones((ny, 1)) * np.linspace(-100, -79, nx)[None, :]
+    psfc = 100000 + rng.normal(0, 800, (ny, nx))
+    p_top = 5000
+    eta = np.linspace(0.997, 0.0, nz)[:, None, None]
+    pressure = p_top + eta * (psfc - p_top)
+    t_sfc = 275 + 0.5 * (45 - lat) + rng.normal(0, 2, (ny, nx))
+    temp = np.maximum(t_sfc * (pressure / psfc) ** 0.19, 210)
+    theta = temp * (100000 / pressure) ** 0.2857
+    qv = 0.6 * 0.622 * 611.2 * np.exp(17.67 * (temp - 273.15) / (temp - 29.65)) / pressure
+
+    with Dataset(path, 'w') as nc:
+        nc.createDimension('Time', 1)
+        nc.createDimension('bottom_top', nz)
+        nc.createDimension('south_north', ny)
+        nc.createDimension('west_east', nx)
+        fields = {'XLAT': lat, 'XLONG': lon, 'PSFC': psfc, 'T2': t_sfc, 'Q2': qv[0],
+                  'PB': pressure * 0.98, 'P': pressure * 0.02, 'T': theta - 300, 'QVAPOR': qv}
+        for name, values in fields.items():
+            dims = ('Time', 'bottom_top', 'south_north', 'west_east') if values.ndim == 3 else ('Time', 'south_north', 'west_east')
+            var = nc.createVariable(name, 'f4', dims)
+            var[0] = values.astype(np.float32)
+
+#writes every input for the given scale into workdir, returns their paths
+def make_inputs(workdir, scale=1.0, seed=0):
+    os.makedirs(workdir, exist_ok=True)
+    inputs = {name: os.path.join(workdir, name) for name in
+              ('soundings.txt', 'global_hourly.csv', 'good_snd_obs.parquet', 'filtered_sfc_obs.parquet', 'training.parquet', 'wrf.nc')}
+    make_igra(inputs['soundings.txt'], int(SOUNDINGS_PER_SCALE * scale), seed)
+    make_global_hourly(inputs['global_hourly.csv'], int(SURFACE_OBS_PER_SCALE * scale), seed)
+    #the combine stage starts from the outputs of the two readers, like it does in the real pipeline
+    write_table(rso.basic_final(rso.read_sounding(inputs['soundings.txt'])), inputs['good_snd_obs.parquet'])
+    syn_df = ris.read_synoptic(inputs['global_hourly.csv'])
+    simple_df = syn_df[["DATE", "TMP_FLT", "DEW_FLT", "PRECIP_TYPE"]].rename(columns={"TMP_FLT": "TMP[C]", "DEW_FLT": "DEWPOINT[C]"})
+    write_table(simple_df, inputs['filtered_sfc_obs.parquet'])
+    write_table(make_training_table(int(TRAINING_ROWS_PER_SCALE * scale), seed), inputs['training.parquet'])
+    side = max(10, int(np.sqrt(WRF_POINTS_PER_SCALE * scale)))
+    make_wrf(inputs['wrf.nc'], side, side, seed=seed)
+    return inputs
+
+#----- stages -----
+#each takes the input paths and the scale and returns how many rows it processed
+
+def bench_read_sounding(inputs, scale):
+    return len(rso.read_sounding(inputs['soundings.txt']).levels)
+
+def bench_filter(inputs, scale):
+    soundings = rso.read_sounding(inputs['soundings.txt'])
+    start = time.perf_counter()
+    rso.filter(soundings)
+    return len(soundings.levels), time.perf_counter() - start
+
+def bench_basic_final(inputs, scale):
+    soundings = rso.filter(rso.read_sounding(inputs['soundings.txt']))
+    start = time.perf_counter()
+    rso.basic_final(soundings)
+    return len(soundings), time.perf_counter() - start
+
+def bench_read_synoptic(inputs, scale):
+    return len(ris.read_synoptic(inputs['global_hourly.csv']))
+
+def bench_better_combine(inputs, scale):
+    css.better_combine(inputs['good_snd_obs.parquet'], inputs['filtered_sfc_obs.parquet'])
+    return len(pd.read_parquet(inputs['good_snd_obs.parquet'], columns=['date']))
+
+def bench_training(inputs, scale):
+    import lightgbm as lgb
+    import lightgbm_model as lm
+    train_data, test_data, split = lm.build_datasets(inputs['training.parquet'], cache_dir=None)
+    lgb.train(dict(lm.params, verbose=-1), train_data, lm.num_round, valid_sets=[test_data])
+    return len(split['X_train'])
+
+def bench_predict(inputs, scale):
+    import lightgbm as lgb
+    booster = lgb.Booster(model_file='lightgbm_model_v1.txt')
+    table = make_training_table(int(PREDICT_ROWS_PER_SCALE * scale))
+    data = table[FEATURES].to_numpy()
+    start = time.perf_counter()
+    booster.predict(data)
+    return len(data), time.perf_counter() - start
+
+#the same model and rows through numpy_gbm, which the prediction scripts use
+def bench_predict_numpy(inputs, scale):
+    from numpy_gbm import NumpyBooster
+    booster = NumpyBooster('lightgbm_model_v1.txt')
+    table = make_training_table(int(PREDICT_ROWS_PER_SCALE * scale))
+    data = table[FEATURES].to_numpy()
+    start = time.perf_counter()
+    booster.predict(data)
+    return len(data), time.perf_counter() - start
+
+def bench_wrf_read(inputs, scale):
+    from netCDF4 import Dataset
+    with Dataset(inputs['wrf.nc']) as nc:
+        fields = [nc.variables[name][0] for name in ('P', 'PB', 'T', 'QVAPOR', 'T2', 'Q2', 'PSFC')]
+    return fields[-1].size
+
+#what wrf_precip.py reads now: the middle quarter of the grid, only the levels up to 850 mb, with tc/td worked out there
+def bench_wrf_window(inputs, scale):
+    from netCDF4 import Dataset
+    from wrf_fields import window_slices, read_window
+    with Dataset(inputs['wrf.nc']) as nc:
+        ny, nx = nc.dimensions['south_north'].size, nc.dimensions['west_east'].size
+        ys, xs = window_slices(nx // 4, 3 * nx // 4, ny // 4, 3 * ny // 4, ny, nx)
+        window = read_window(nc, ys, xs)
+    return window['sfc_t'].size
+
+#tc and td of the whole grid to 925 and 850 mb, timed without reading them
+def bench_wrf_interp(inputs, scale):
+    from netCDF4 import Dataset
+    from wrf_fields import window_slices, read_window, interpolate_levels
+    with Dataset(inputs['wrf.nc']) as nc:
+        ny, nx = nc.dimensions['south_north'].size, nc.dimensions['west_east'].size
+        window = read_window(nc, *window_slices(0, nx - 1, 0, ny - 1, ny, nx))
+    start = time.perf_counter()
+    interpolate_levels(window['p'], [window['tc'], window['td']], (925, 850))
+    return window['sfc_t'].size, time.perf_counter() - start
+
+#name -> function. A stage that needs setup (e.g. parsing its input) returns (rows, seconds) to only time the part it measures
+STAGES = {
+    'read_sounding': bench_read_sounding,
+    'filter': bench_filter,
+    'basic_final': bench_basic_final,
+    'read_synoptic': bench_read_synoptic,
+    'better_combine': bench_better_combine,
+    'training': bench_training,
+    'predict': bench_predict,
+    'predict_numpy': bench_predict_numpy,
+    'wrf_read': bench_wrf_read,
+    'wrf_window': bench_wrf_window,
+    'wrf_interp': bench_wrf_interp,
+}
+
+def _run_stage(name, inputs, scale):
+    from lightgbm_model import peak_memory_mb
+    start = time.perf_counter()
+    result = STAGES[name](inputs, scale)
+    seconds = time.perf_counter() - start
+    rows, seconds = result if isinstance(result, tuple) else (result, seconds)
+    peak = peak_memory_mb()
+    return {'seconds': round(seconds, 4), 'rows': int(rows), 'rows_per_s': round(rows / seconds, 1) if seconds else None,
+            'peak_mb': round(peak, 1) if peak is not None else None}
+
+#runs each stage in a fresh process (so peak memory doesn't carry over from earlier stages) and returns {stage: result}
+def run_benchmarks(inputs, scale=1.0, stages=None):
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in stages or STAGES:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = pool.submit(_run_stage, name, inputs, scale).result()
+        print(name.ljust(16), f"{results[name]['seconds']:9.3f} s", f"{results[name]['rows_per_s'] or 0:14.0f} rows/s",
+              f"{results[name]['peak_mb'] or 0:9.1f} MB")
+    return results
+
+#stages that got slower or bigger than the baseline by more than tolerance, as {stage: [what regressed]}
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ('seconds', 'peak_mb'):
+            old, new = baseline[name].get(key), result.get(key)
+            if old and new and new > old * (1 + tolerance):
+                regressions.setdefault(name, []).append(f"{key} {old} -> {new} (+{100 * (new / old - 1):.0f}%)")
+    return regressions
+
+def main():
+    #size of the synthetic inputs, 1.0 is ~20k soundings, 200k surface obs and 200k training rows
+    scale = 1.0
+    workdir = "bench_data"
+    #results of a run on this machine to compare against. Written on the first run (or when update_baseline is set)
+    baseline_path = "benchmark_baseline.json"
+    update_baseline = False
+
+    start = time.perf_counter()
+    inputs = make_inputs(workdir, scale)
+    print("generated inputs in", round(time.perf_counter() - start, 1), "s")
+    results = run_benchmarks(inputs, scale)
+
+    run = {'scale': scale, 'date': datetime.now().isoformat(timespec='seconds'), 'stages': results}
+    if update_baseline or not os.path.exists(baseline_path):
+        with open(baseline_path, 'w') as file:
+            json.dump(run, file, indent=1)
+        print("baseline written to", baseline_path)
+        return 0
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    if baseline['scale'] != scale:
+        print("baseline was run at scale", baseline['scale'], "- not comparing")
+        return 0
+    regressions = compare_to_baseline(results, baseline['stages'])
+    for name, problems in regressions.items():
+        print("REGRESSION", name, ", ".join(problems))
+    if not regressions:
+        print("no regressions against", baseline_path)
+    return 0
+
+if __name__=="__main__":
+    main()
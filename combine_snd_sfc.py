@@ -1,114 +1,183 @@
 # File to combine cleaned sounding and surface obs into one big file
 # Input is the output of read_integrated_sfcobs.py and read_sounding_obs.py
-# Output is a file with the following columns. Note, values are comma separated
+# Output is a file with the following columns (parquet/feather, or comma separated for a .csv name, see table_io.py)
 # date in UTC (YYYY-MM-DDHH:MM:SS), surface temp (C), surface dewpoint (C), 925 mb temp, 925 mb dewpoint, 850 mb temp, 850 mb dewpoint, precipitation type
 # 
 # Precipitation type is indicated with the values 0,1,2, where 0 indicates rain, 1 mixed precip, and 2 is frozen (snow, graupel, ice pellets, NOT hail)
 
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import matplotlib.pyplot as plt
+from table_io import read_table, write_table
+
+#finds every (sounding, surface ob) pair that is within tolerance of each other in time
+#both time arrays have to be sorted. Returns the positions of the sounding and surface ob of each pair,
+#grouped by sounding and in time order within each sounding
+def window_pairs(snd_times, sfc_times, tolerance):
+    lo = np.searchsorted(sfc_times, snd_times - tolerance, side="left")
+    hi = np.searchsorted(sfc_times, snd_times + tolerance, side="right")
+    counts = hi - lo
+    snd_idx = np.repeat(np.arange(len(snd_times)), counts)
+    #for each pair, lo of its sounding plus its position within the sounding's window
+    sfc_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    return snd_idx, sfc_idx
+
+#for each sounding that has a pair where `valid` holds, the pair closest in time (ties go to the earlier ob)
+#returns the soundings that have one and the chosen pair for each
+def nearest_valid(snd_idx, time_dif, valid):
+    candidates = np.flatnonzero(valid)
+    order = candidates[np.lexsort((candidates, time_dif[candidates], snd_idx[candidates]))]
+    owner = snd_idx[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = owner[1:] != owner[:-1]
+    return owner[first], order[first]
+
+#core of the joins below. snd_keys and sfc_keys are sorted times (or any sortable number where only obs of the same
+#sounding are within tolerance), sfc_df is in the same order as sfc_keys and has TMP, DEW and PRECIP_TYPE columns
+#returns the nearest surface temperature, dewpoint and the precip type for every sounding (NaN / -1 when there is none)
+def match_surface_obs(snd_keys, sfc_keys, sfc_df, tolerance):
+    snd_idx, sfc_idx = window_pairs(snd_keys, sfc_keys, tolerance)
+    time_dif = np.abs(snd_keys[snd_idx] - sfc_keys[sfc_idx])
+
+    temps = sfc_df['TMP'].to_numpy(dtype=float)[sfc_idx]
+    dews = sfc_df['DEW'].to_numpy(dtype=float)[sfc_idx]
+    precip = sfc_df['PRECIP_TYPE'].to_numpy()[sfc_idx]
+
+    nearest_temp = np.full(len(snd_keys), np.nan)
+    owner, chosen = nearest_valid(snd_idx, time_dif, temps < 500) #a value less than 500 indicates this is not a missing value 
+    nearest_temp[owner] = temps[chosen]
+    nearest_dew = np.full(len(snd_keys), np.nan)
+    owner, chosen = nearest_valid(snd_idx, time_dif, dews < 500)
+    nearest_dew[owner] = dews[chosen]
+
+    #if all the obs in the window agree on precip type we use it, otherwise this is a transition period and we call it mixed
+    precip_type = np.full(len(snd_keys), -1)
+    if len(snd_idx):
+        starts = np.flatnonzero(np.r_[True, snd_idx[1:] != snd_idx[:-1]])
+        lowest = np.minimum.reduceat(precip, starts)
+        highest = np.maximum.reduceat(precip, starts)
+        precip_type[snd_idx[starts]] = np.where(lowest == highest, lowest, 1)
+    return nearest_temp, nearest_dew, precip_type
+
+#vectorized join of soundings to the surface obs around them
+#snd_df has a date column and the sounding features, sfc_df has DATE, TMP, DEW and PRECIP_TYPE columns
+#for each sounding, every surface ob within tolerance is found. The closest valid (under 500, so not missing) temperature
+#and dewpoint are picked independently, and if the obs in the window disagree on precip type it is marked as mixed (1)
+#soundings without a valid surface temperature and dewpoint are dropped
+def combine_frames(snd_df, sfc_df, tolerance=timedelta(hours=1)):
+    snd_df = snd_df.dropna(subset=['date']).sort_values(by='date', kind='stable').reset_index(drop=True)
+    sfc_df = sfc_df.sort_values(by='DATE', kind='stable').reset_index(drop=True)
+    snd_times = snd_df['date'].to_numpy(dtype='datetime64[ns]')
+    sfc_times = sfc_df['DATE'].to_numpy(dtype='datetime64[ns]')
+
+    nearest_temp, nearest_dew, precip_type = match_surface_obs(snd_times, sfc_times, sfc_df, np.timedelta64(pd.Timedelta(tolerance)))
+
+    combined = pd.DataFrame({'date': snd_df['date'], 'sfc_t': nearest_temp, 'sfc_td': nearest_dew})
+    features = snd_df.drop(columns='date')
+    combined = pd.concat([combined, features], axis=1)
+    combined['precip_type'] = precip_type
+    #we didn't find what we were looking for, drop the sounding
+    return combined.dropna(subset=['sfc_t', 'sfc_td']).reset_index(drop=True)
+
+EARTH_RADIUS_KM = 6371.0
+
+#station lat/lons (degrees) as points on the unit sphere, so straight line distances can be searched with a KD-tree
+def unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)))
+
+#every (sounding station, surface station) pair within radius_km of each other
+#both metadata frames have station, lat and lon columns. One KD-tree is built over the surface stations and all sounding
+#stations are looked up in it at once. Returns station, sfc_station and distance_km (great circle) columns
+def nearby_stations(snd_stations, sfc_stations, radius_km=100):
+    from scipy.spatial import cKDTree
+
+    snd_xyz = unit_vectors(snd_stations['lat'], snd_stations['lon'])
+    sfc_xyz = unit_vectors(sfc_stations['lat'], sfc_stations['lon'])
+    tree = cKDTree(sfc_xyz)
+    #chord length matching the great circle radius
+    chord = 2*np.sin(radius_km / (2*EARTH_RADIUS_KM))
+    matches = tree.query_ball_point(snd_xyz, chord)
+
+    counts = np.array([len(m) for m in matches], dtype=np.int64)
+    snd_pos = np.repeat(np.arange(len(snd_stations)), counts)
+    sfc_pos = np.concatenate([np.asarray(m, dtype=np.int64) for m in matches]) if counts.sum() else np.zeros(0, dtype=np.int64)
+    dot = np.clip(np.einsum('ij,ij->i', snd_xyz[snd_pos], sfc_xyz[sfc_pos]), -1, 1)
+    return pd.DataFrame({
+        'station': snd_stations['station'].to_numpy()[snd_pos],
+        'sfc_station': sfc_stations['station'].to_numpy()[sfc_pos],
+        'distance_km': EARTH_RADIUS_KM*np.arccos(dot),
+    })
+
+#spatial version of combine_frames: pairs every sounding with the obs of every surface station within radius_km
+#snd_df has date, station and the sounding features (e.g. the partitions from read_sounding_obs.process_station_dir)
+#sfc_df has STATION, DATE, TMP, DEW and PRECIP_TYPE. snd_stations and sfc_stations hold station, lat and lon
+#all (sounding, surface station) pairs are joined in one pass by giving every surface station its own stretch of the
+#time axis, so a window can never reach another station's obs. Returns one row per (sounding, surface station) pair
+def combine_spatial(snd_df, sfc_df, snd_stations, sfc_stations, radius_km=100, tolerance=timedelta(hours=1)):
+    #NaT (e.g. a sounding with an unknown hour) has no place on the time axis, its key would wrap around int64
+    snd_df = snd_df.dropna(subset=['date'])
+    sfc_df = sfc_df.dropna(subset=['DATE'])
+    pairs = nearby_stations(snd_stations, sfc_stations, radius_km)
+    #each surface station gets a code, keys are code * offset + seconds
+    codes = pd.Index(pd.unique(sfc_df['STATION']))
+    pairs = pairs[pairs['sfc_station'].isin(codes)]
+    left = snd_df.merge(pairs, on='station', how='inner')
+
+    offset = np.int64(10**10) #about 300 years of seconds
+    tol = np.int64(pd.Timedelta(tolerance).total_seconds())
+    left_keys = codes.get_indexer(left['sfc_station']).astype(np.int64)*offset + left['date'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    sfc_keys = codes.get_indexer(sfc_df['STATION']).astype(np.int64)*offset + sfc_df['DATE'].to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+    left_order = np.argsort(left_keys, kind='stable')
+    sfc_order = np.argsort(sfc_keys, kind='stable')
+    left = left.iloc[left_order].reset_index(drop=True)
+    sfc_sorted = sfc_df.iloc[sfc_order].reset_index(drop=True)
+
+    nearest_temp, nearest_dew, precip_type = match_surface_obs(left_keys[left_order], sfc_keys[sfc_order], sfc_sorted, tol)
+
+    ids = left[['date', 'station', 'sfc_station', 'distance_km']]
+    features = left.drop(columns=['date', 'station', 'sfc_station', 'distance_km'])
+    combined = pd.concat([ids, pd.DataFrame({'sfc_t': nearest_temp, 'sfc_td': nearest_dew}), features], axis=1)
+    combined['precip_type'] = precip_type
+    return combined.dropna(subset=['sfc_t', 'sfc_td']).reset_index(drop=True)
+
+#takes surface obs as written by read_integrated_sfcobs.py and gets them ready for the joins above
+#the model is rain vs snow, so mixed obs (1) are dropped and frozen (2) becomes 1
+def prepare_surface_obs(sfc_df):
+    sfc_df = sfc_df[sfc_df['PRECIP_TYPE'] != 1]
+    sfc_df = sfc_df.replace(to_replace={'PRECIP_TYPE':2}, value=1)
+    return sfc_df.rename(columns={'TMP[C]':'TMP', 'DEWPOINT[C]':'DEW'})
 
-def better_combine(snd_path, sfc_path):
-    #all the rows of the CSV which is to be written
-    rows = []
+def better_combine(snd_path, sfc_path, tolerance=timedelta(hours=1)):
+    #read the sounding data into a Pandas dataframe, the 'date' column comes back as a datetime (see table_io.py)
+    snd_df: pd.DataFrame = read_table(snd_path)
+    #read in sfc obs. format is: datetime, temp, dew, precip type, similar to the sounding obs
+    sfc_df: pd.DataFrame = read_table(sfc_path)
+    sfc_df = prepare_surface_obs(sfc_df)
 
-    #read the sounding data into a Pandas dataframe, telling it to parse the 'date' column into a datetime object and then sort the values by date
-    snd_df: pd.DataFrame = pd.read_csv(snd_path, dtype={'t925':float, 'td925':float, 't850':float, 'td850':float}, parse_dates=['date'])
-    snd_df = snd_df.sort_values(by='date')
-    #read in sfc obs. format is: row, datetime, temp, dew, precip type, similar to the sounding obs
-    sfc_df: pd.DataFrame = pd.read_csv(sfc_path, dtype={'TMP[C]':float, 'DEWPOINT[C]':float, 'PRECIP_TYPE':int}, parse_dates=['DATE'])
-    sfc_df = sfc_df[sfc_df['PRECIP_TYPE'] != 1]
-    sfc_df.replace(to_replace={'PRECIP_TYPE':2}, value=1, inplace=True)
-    sfc_df.rename(columns={'TMP[C]':'TMP', 'DEWPOINT[C]':'DEW'}, inplace=True)
-    sfc_df = sfc_df.sort_values(by='DATE')
-
-    #here's where the magic happens, we have the sounding and surface obs sorted by the dates in them
-    #now we want to match surface obs to relevant sounding observations
-    #we could check every single entry against every single other entry, but that takes a LOOOONNGGG time
-    #instead, because these are sorted by date, when we've passed the date of the sounding in sfc_obs, then we move on as there will be no match beyond this
-    start_j = 0
-    for i in range(len(snd_df)):
-        #iterate through each sounding, extracting the date for each
-        snd_date = snd_df.iloc[i].date
-        sounding = snd_df.iloc[i]
-        sfc_obs_near = [] #this holds all the surface obs near in time 
-        for j in range(start_j, len(sfc_df)):
-            #iterate through each sfc ob, extract the date and the ob as a whole
-            sfc_date = sfc_df.iloc[j].DATE
-            obs = sfc_df.iloc[j]
-
-            #check the difference between the sounding time and sfc ob time
-            time_dif = abs(snd_date - sfc_date)
-            if time_dif <= timedelta(hours=1):
-                #if the difference is less than or equal to 1 hour, then we appened it to nearby sfc obs and update the start j
-                sfc_obs_near.append([time_dif, obs.TMP, obs.DEW, obs.PRECIP_TYPE])
-                start_j = j #we pick up at this point next time
-                #break #think this break shouldn't be here. As we don't want to break on the first nearby ob
-            
-            #then we've passed all relevant obs and we should just move to the next sonde
-            if time_dif >= timedelta(hours=2) and sfc_date > snd_date:
-                start_j = j
-                break
-
-
-        #the logic on this next part is a touch complex so hang in there with me
-        #essentially, we iterate through all nearby (within 1 hour) surface obs of the sounding
-        #we are just checking for which is best, by finding the one that doesn't have missing obs and is closest
-        #so if there is an ob on the hour, but it's missing a dewpoint, then we try and find an ob that is close but not missing the value
-        precip_types = []
-        nearest_temp = None
-        nearest_dew = None
-        temp_time = timedelta(hours=2) #initialize timedelta as 2 hours, greater than any of the sfcobs diffs should be 
-        dew_time = timedelta(hours=2)
-        for i in range(len(sfc_obs_near)):
-            precip_types.append(sfc_obs_near[i][3])
-            if sfc_obs_near[i][0] < temp_time and sfc_obs_near[i][1] < 500: #a value less than 500 indicates this is not a missing value 
-                temp_time = sfc_obs_near[i][0] #NOTE: this is a timedelta, NOT a datetime value
-                nearest_temp = sfc_obs_near[i][1]
-
-            if sfc_obs_near[i][0] < dew_time and sfc_obs_near[i][2] < 500:
-                dew_time = sfc_obs_near[i][0]
-                nearest_dew = sfc_obs_near[i][2]
-
-        if nearest_temp == None or nearest_dew == None:
-            continue
-            #we didn't find what we were looking for, move to the next sounding
-        
-        #however, if we did find multiple valid observations, then we need to check if there precip types are the same
-        #if they are, then we have no issues. If they are not, then we indicate is mixed precip as this is a transition period
-        precip_type = -1
-        precip_types = set(precip_types)
-        if len(precip_types) > 1:
-            precip_type = 1
-        else:
-            precip_type = list(precip_types)[0]
-        
-        #write the string for the row that will be in the CSV and append it to the rows list
-        row = snd_date.strftime("%Y-%m-%dT%H:00:00")+","+str(nearest_temp)+","+str(nearest_dew)+","+str(sounding.t925)+","+str(sounding.td925)+","+str(sounding.t850)+","+str(sounding.td850)+","+str(precip_type)
-        rows.append(row)  
-
-    return rows
+    #here's where the magic happens: both frames get sorted by date and every surface ob within tolerance of a
+    #sounding is found with a binary search instead of checking every entry against every other entry
+    return combine_frames(snd_df, sfc_df, tolerance)
 
 def main():
     #path to data
 
     datapath = "."
-    synoptic = "filtered_gb_synoptic_obs.csv"
+    synoptic = "filtered_gb_synoptic_obs.parquet"
 
     sfc_file = os.path.join(datapath, synoptic)
 
     datapath = ".\\ml_experiments"
-    synoptic = "good_snd_obs.csv"
+    synoptic = "good_snd_obs.parquet"
     snd_file = os.path.join(datapath, synoptic)
 
-    all_rows = better_combine(snd_file, sfc_file)
-    #open a file and write all the resulting rows to it
-    with open("ultimate_dataset3.csv", 'w') as file:
-         file.write("date,sfc_t,sfc_td,t925,td925,t850,td850,precip_type\n")
-         for item in all_rows:
-             file.write(item + '\n')
+    combined = better_combine(snd_file, sfc_file)
+    #write all the resulting rows to a file, use a .csv name for plain text
+    write_table(combined, "ultimate_dataset3.parquet")
     # return 0
 
 if __name__=="__main__":
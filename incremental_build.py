@@ -0,0 +1,244 @@
+#incremental version of running read_sounding_obs.py, read_integrated_sfcobs.py and combine_snd_sfc.py
+#instead of reprocessing the whole history every time, this keeps a small state file with a high-water mark per station
+#(the last sounding/surface ob date already processed) and per input file (how far into it we've read),
+#then only parses what was appended since the last run, joins it with a small overlap window and
+#replaces (upserts) only the affected rows of the combined dataset
+
+import io
+import os
+import json
+import hashlib
+import pandas as pd
+from datetime import timedelta
+
+import read_sounding_obs as rso
+import read_integrated_sfcobs as ris
+import combine_snd_sfc as css
+from table_io import read_table, write_table
+
+#how many bytes before the resume point are hashed to make sure the start of an input file hasn't changed
+PREFIX_CHECK_BYTES = 4096
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {"soundings": {}, "surface": {}, "stations": {}, "outputs": {}}
+    with open(state_path) as file:
+        return json.load(file)
+
+#the state is written to a temporary file first, so a crash never leaves half a state file behind
+def save_state(state_path, state):
+    tmp = state_path + ".tmp"
+    with open(tmp, "w") as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+    os.replace(tmp, state_path)
+
+def _prefix_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+#reads the bytes of an input file (sounding or surface obs) from offset on. Plain files are seeked into, archives are decompressed
+#and the part before offset is skipped. Returns None if the part before offset doesn't match what was read last time
+#(the file was rewritten rather than appended to), in which case the caller starts over from the beginning
+def _read_from(snd_file, offset, prefix_hash):
+    with rso.open_sounding_file(snd_file) as file:
+        start = max(0, offset - PREFIX_CHECK_BYTES)
+        if not snd_file.endswith((".gz", ".zip")):
+            file.seek(start)
+        else:
+            remaining = start
+            while remaining > 0:
+                skipped = file.read(min(remaining, 8*1024*1024))
+                if not skipped:
+                    break
+                remaining -= len(skipped)
+        prefix = file.read(offset - start)
+        if offset and (len(prefix) != offset - start or _prefix_hash(prefix) != prefix_hash):
+            return None
+        return prefix, file.read()
+
+#length of the part of IGRA data that holds only whole soundings. A sounding still being written (fewer level lines than
+#the level count in its header, columns 33-36) is cut off along with any partial last line, so it is read whole next run
+def _complete_soundings_length(data):
+    end = data.rfind(b"\n") + 1
+    last = data.rfind(b"\n#", 0, end)
+    start = last + 1 if last >= 0 else (0 if data.startswith(b"#") else -1)
+    if start < 0:
+        return end
+    header_end = data.find(b"\n", start)
+    if header_end < 0 or header_end + 1 > end:
+        return start
+    try:
+        num_levels = int(data[start + 32:start + 36])
+    except ValueError:
+        return end
+    return end if data.count(b"\n", header_end + 1, end) >= num_levels else start
+
+#soundings appended to snd_file since the last run, as basic_final rows with a parsed date
+#updates the file's entry in the state (byte offset and prefix hash) and the per-station date watermarks
+def new_soundings(snd_file, state, target_levels=(925, 850)):
+    key = os.path.abspath(snd_file)
+    entry = state["soundings"].get(key, {"offset": 0, "prefix": ""})
+
+    read = _read_from(snd_file, entry["offset"], entry["prefix"])
+    if read is None:
+        entry = {"offset": 0, "prefix": ""}
+        read = _read_from(snd_file, 0, "")
+    prefix, data = read
+    data = data[:_complete_soundings_length(data)]
+
+    soundings = rso.parse_igra(data)
+    frames = []
+    for station in soundings.index["station"].unique():
+        features = rso.select_levels(soundings.take((soundings.index["station"] == station).to_numpy()), target_levels)
+        features["station"] = station
+        frames.append(features)
+    if not frames:
+        columns = ["date"] + [f"{v}{t:g}" for t in target_levels for v in ("t", "td")] + ["station"]
+        return pd.DataFrame({"date": pd.to_datetime([])}, columns=columns)
+    features = pd.concat(frames, ignore_index=True)
+    features["date"] = pd.to_datetime(features["date"], format="%Y-%m-%dT%H:%M:%S", errors="coerce")
+    features = features.dropna(subset=["date"]) #soundings without an hour (99)
+
+    #the date watermark also covers files that had to be read from the start again
+    watermarks = state["stations"]
+    last_seen = pd.to_datetime(features["station"].map(lambda s: watermarks.get("snd:" + s, "1900-01-01")))
+    features = features[features["date"] > last_seen].reset_index(drop=True)
+    for station, last in features.groupby("station")["date"].max().items():
+        watermarks["snd:" + station] = last.isoformat()
+
+    whole = prefix + data
+    state["soundings"][key] = {"offset": entry["offset"] + len(data), "prefix": _prefix_hash(whole[-PREFIX_CHECK_BYTES:])}
+    return features
+
+#surface obs appended since the last run. Like the soundings, each file is read from where the last run stopped (checked
+#with a hash of the bytes before that point) and the saved header line is put in front of the new bytes, so a nightly
+#append to a decades long file only parses and classifies the new rows. Files whose size and modification time haven't
+#changed are skipped without opening them. Only obs after each station's date watermark are kept
+def new_surface_obs(sfc_files, state):
+    frames = []
+    for sfc_file in sfc_files:
+        key = os.path.abspath(sfc_file)
+        stat = os.stat(key)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        entry = state["surface"].get(key)
+        #state files from before resuming was added only hold the fingerprint, those files are read again from the start
+        entry = entry if isinstance(entry, dict) else {"offset": 0, "prefix": "", "header": ""}
+        if entry.get("fingerprint") == fingerprint:
+            continue
+
+        read = _read_from(sfc_file, entry["offset"], entry["prefix"]) if entry["header"] else None
+        if read is None:
+            entry = {"offset": 0, "prefix": "", "header": ""}
+            read = _read_from(sfc_file, 0, "")
+        prefix, data = read
+        #a line that is still being written is left for the next run
+        data = data[:data.rfind(b"\n") + 1]
+        if entry["header"]:
+            header = entry["header"].encode("latin-1")
+            text = header + data
+        else:
+            header = data[:data.find(b"\n") + 1]
+            text = data
+        if not header:
+            continue #nothing complete in the file yet
+        frames.append(ris.read_synoptic(io.BytesIO(text)))
+
+        whole = prefix + data
+        state["surface"][key] = {"fingerprint": fingerprint, "offset": entry["offset"] + len(data),
+                                 "prefix": _prefix_hash(whole[-PREFIX_CHECK_BYTES:]), "header": header.decode("latin-1")}
+    if not frames:
+        return ris.read_synoptic_empty()
+
+    syn_df = pd.concat(frames, ignore_index=True)
+    dates = pd.to_datetime(syn_df["DATE"])
+    watermarks = state["stations"]
+    last_seen = pd.to_datetime(syn_df["STATION"].map(lambda s: watermarks.get("sfc:" + s, "1900-01-01")))
+    syn_df = syn_df[dates > last_seen].reset_index(drop=True)
+    for station, last in pd.to_datetime(syn_df["DATE"]).groupby(syn_df["STATION"]).max().items():
+        watermarks["sfc:" + station] = last.isoformat()
+    return syn_df
+
+#the stage CSVs are appended to before the dataset and the state are written. The state keeps their sizes as of the
+#last finished run, and anything a failed run appended after that is cut off again before the run is redone, so the
+#same rows are never appended twice. State files from before this have no sizes and are left as they are
+def _roll_back_outputs(state, paths):
+    sizes = state.get("outputs")
+    if sizes is None:
+        return
+    for path in paths:
+        size = sizes.get(os.path.abspath(path), 0)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as file:
+                file.truncate(size)
+
+def _record_outputs(state, paths):
+    state["outputs"] = {os.path.abspath(path): os.path.getsize(path) for path in paths if os.path.exists(path)}
+
+#appends rows to a stage CSV, writing the header only if the file is new
+def _append_csv(frame, path, index=False):
+    exists = os.path.exists(path)
+    frame.to_csv(path, mode="a", header=not exists, index=index)
+
+#brings all three stage outputs up to date with what was appended to the inputs since the last run
+#the combined dataset is only rewritten from the earliest affected sounding on: soundings after the new data's start,
+#and soundings within `overlap` of a new surface ob, are joined again, everything before that is left alone
+def update(snd_files, sfc_files, snd_out, sfc_out, dataset_out, state_path, overlap=timedelta(hours=1)):
+    state = load_state(state_path)
+    _roll_back_outputs(state, (snd_out, sfc_out))
+
+    new_snd = pd.concat([new_soundings(f, state) for f in snd_files], ignore_index=True) if snd_files else pd.DataFrame()
+    new_sfc = new_surface_obs(sfc_files, state)
+
+    if len(new_snd):
+        out = new_snd.drop(columns="station").sort_values("date", kind="stable")
+        out["date"] = out["date"].dt.strftime("%Y-%m-%dT%H:00:00")
+        _append_csv(out, snd_out)
+    if len(new_sfc):
+        simple_df = new_sfc[["DATE", "TMP_FLT", "DEW_FLT", "PRECIP_TYPE"]].rename(columns={"TMP_FLT":"TMP[C]", "DEW_FLT":"DEWPOINT[C]"})
+        _append_csv(simple_df, sfc_out, index=True)
+
+    #earliest sounding whose combined row can change
+    starts = []
+    if len(new_snd):
+        starts.append(new_snd["date"].min())
+    if len(new_sfc):
+        starts.append(pd.to_datetime(new_sfc["DATE"]).min() - overlap)
+    if not starts:
+        _record_outputs(state, (snd_out, sfc_out))
+        save_state(state_path, state)
+        return 0
+    cutoff = min(starts)
+
+    snd_df = read_table(snd_out)
+    snd_df = snd_df[snd_df["date"] >= cutoff]
+    sfc_df = read_table(sfc_out)
+    sfc_df = css.prepare_surface_obs(sfc_df[sfc_df["DATE"] >= cutoff - overlap])
+    combined = css.combine_frames(snd_df, sfc_df, overlap)
+
+    #upsert: drop the rows from cutoff on and put the recomputed ones in their place
+    #the dataset can be any format table_io.py knows, the stage files above stay CSV so new rows can be appended
+    if os.path.exists(dataset_out):
+        dataset = read_table(dataset_out)
+        dataset = dataset[dataset["date"] < cutoff]
+        combined = pd.concat([dataset, combined], ignore_index=True)
+    combined = combined.sort_values("date", kind="stable")
+    tmp = dataset_out + ".tmp" + os.path.splitext(dataset_out)[1]
+    write_table(combined, tmp)
+    os.replace(tmp, dataset_out)
+
+    #only saved once every output is written, so a failed run is simply redone next time (see _roll_back_outputs)
+    _record_outputs(state, (snd_out, sfc_out))
+    save_state(state_path, state)
+    return len(new_snd) + len(new_sfc)
+
+def main():
+    #paths to data, same inputs and outputs as the three stage scripts
+    datapath = ".\data"
+    snd_files = [os.path.join(datapath, "USM00072645-data.txt")]
+    sfc_files = [os.path.join(datapath, "gb_synoptic.csv")]
+
+    n_new = update(snd_files, sfc_files, "good_snd_obs.csv", "filtered_gb_synoptic_obs.csv", "ultimate_dataset3.csv", "build_state.json")
+    print(n_new, "new soundings and surface obs")
+    return 0
+
+if __name__=="__main__":
+    main()
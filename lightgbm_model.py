@@ -1,23 +1,191 @@
 import pandas as pd
+import numpy as np
 import lightgbm as lgb
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import roc_auc_score as ras
 import os
+import json
+import shutil
+import hashlib
+from table_io import read_table, table_columns
 
-#dataset of format specified in combine_snd_sfc.py read into pandas dataframe
-df = pd.read_csv(os.path.join('.','ultimate_dataset2.csv'))
+#how the dataset is split 80/20 into training and validation data
+SPLIT_SEED = 2023
+TEST_SIZE = 0.2
+#how LightGBM bins each feature when the Datasets are built. These are LightGBM's defaults, written out because changing
+#any of them changes the binned Datasets, so they are part of the cache key below
+DATASET_PARAMS = {
+    'max_bin': 255,
+    'min_data_in_bin': 3,
+    'bin_construct_sample_cnt': 200000,
+    'data_random_seed': 1,
+}
+
+#binary Dataset cache. Building the Datasets means reading the whole dataset and binning every feature, which is the
+#same every run as long as the data, split and binning don't change. So the constructed train/validation Datasets are
+#saved in LightGBM's binary format (plus the split itself, for predicting) under a key made from a hash of the data file's
+#contents, the split and DATASET_PARAMS, and later runs load them straight back
+DATASET_CACHE_VERSION = 2 #bump this whenever build_datasets changes what goes into the Datasets
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(8*1024*1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def dataset_cache_key(path, seed=SPLIT_SEED, test_size=TEST_SIZE, dataset_params=DATASET_PARAMS):
+    fingerprint = json.dumps([file_digest(path), seed, test_size, dataset_params, DATASET_CACHE_VERSION], sort_keys=True)
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:20]
+
+#columns of a dataset that aren't features: the label, the date, and the station ids/distance that combine_spatial adds.
+#Both the in-memory and the partitioned training leave these out
+NON_FEATURE_COLUMNS = ('date', 'precip_type', 'station', 'sfc_station', 'distance_km')
+
+#create label and target datasets for model to train on, from a dataset of format specified in combine_snd_sfc.py
+#(.csv, .parquet or .feather)
+def load_features(path):
+    df = read_table(path)
+    features = df.drop(columns=[c for c in NON_FEATURE_COLUMNS if c in df.columns])
+    target = df['precip_type'].astype(int)
+    return features, target
+
+#returns the train and validation Datasets, ready for lgb.train, and the split itself as
+#{'X_train', 'X_val', 'Y_train', 'Y_val'}. With cache_dir=None nothing is cached
+def build_datasets(path, seed=SPLIT_SEED, test_size=TEST_SIZE, dataset_params=DATASET_PARAMS, cache_dir="lgb_dataset_cache"):
+    entry = None
+    if cache_dir is not None:
+        entry = os.path.join(cache_dir, dataset_cache_key(path, seed, test_size, dataset_params))
+        if os.path.exists(os.path.join(entry, 'meta.json')):
+            return load_cached_datasets(entry, dataset_params)
+
+    features, target = load_features(path)
+    #split dataset 80/20 into training and validation dataset
+    X_train, X_val, Y_train, Y_val = train_test_split(features, target, test_size=test_size, random_state=seed)
+
+    #put into dataset which lgbm can use
+    train_data = lgb.Dataset(X_train, label=Y_train, params=dict(dataset_params), free_raw_data=False)
+    test_data = lgb.Dataset(X_val, label=Y_val, reference=train_data, params=dict(dataset_params), free_raw_data=False)
+    split = {'X_train': X_train, 'X_val': X_val, 'Y_train': Y_train, 'Y_val': Y_val}
+    if entry is None:
+        return train_data, test_data, split
+
+    train_data.construct()
+    test_data.construct()
+    tmp = entry + '.tmp-' + str(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    train_data.save_binary(os.path.join(tmp, 'train.bin'))
+    test_data.save_binary(os.path.join(tmp, 'valid.bin'))
+    np.savez(os.path.join(tmp, 'split.npz'), columns=np.array(features.columns, dtype=str),
+             **{name: np.asarray(values) for name, values in split.items()})
+    with open(os.path.join(tmp, 'meta.json'), 'w') as file:
+        json.dump({'source': os.path.abspath(path), 'seed': seed, 'test_size': test_size, 'dataset_params': dataset_params,
+                   'rows': {'train': len(X_train), 'valid': len(X_val)}}, file)
+    if os.path.exists(entry):
+        shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp, entry)
+    return train_data, test_data, split
+
+#loads the Datasets saved by build_datasets. They are already binned, so constructing them only reads the files
+def load_cached_datasets(entry, dataset_params=DATASET_PARAMS):
+    train_data = lgb.Dataset(os.path.join(entry, 'train.bin'), params=dict(dataset_params))
+    test_data = lgb.Dataset(os.path.join(entry, 'valid.bin'), reference=train_data, params=dict(dataset_params))
+    with np.load(os.path.join(entry, 'split.npz')) as arrays:
+        columns = list(arrays['columns'])
+        split = {'X_train': pd.DataFrame(arrays['X_train'], columns=columns), 'X_val': pd.DataFrame(arrays['X_val'], columns=columns),
+                 'Y_train': pd.Series(arrays['Y_train'], name='precip_type'), 'Y_val': pd.Series(arrays['Y_val'], name='precip_type')}
+    return train_data, test_data, split
+
+#out-of-core training, for datasets split over many files (e.g. one per station or year) that don't fit in memory together
+#the files are streamed into LightGBM through lgb.Sequence: LightGBM first samples rows to find the bins, then reads
+#the data a batch at a time and only keeps the binned values, so the full feature matrix is never built in pandas.
+#Only one file's features are held at a time, next to the labels of every row
+
+#partition files picked up in a dataset directory (searched recursively, so station=<id>/ folders work)
+PARTITION_FILE_TYPES = (".parquet", ".feather", ".csv")
 
-#create label and target datasets for model to train on
-features = df.drop('precip_type', axis=1)
-features = features.drop('date',axis=1)
-target = df['precip_type']
+def partition_files(directory):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(directory) for name in names
+                  if name.endswith(PARTITION_FILE_TYPES))
 
-#split dataset 80/20 into training and validation dataset
-X_train, X_val, Y_train, Y_val = train_test_split(features, target, test_size=0.2, random_state=2023)
+#rows of a set of partition files, as one table. rows[i] holds the positions of the rows used from files[i]
+class PartitionSequence(lgb.Sequence):
+    batch_size = 65536
 
-#put into dataset which lgbm can use
-train_data = lgb.Dataset(X_train, label=Y_train)
-test_data = lgb.Dataset(X_val, label=Y_val, reference=train_data)
+    def __init__(self, files, rows, columns):
+        self.files = files
+        self.rows = rows
+        self.columns = columns
+        self.ends = np.cumsum([len(r) for r in rows])
+        self._loaded = (None, None)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    #features of the used rows of one file, the last file read is kept since LightGBM reads in order
+    def _file(self, i):
+        if self._loaded[0] != i:
+            self._loaded = (None, None) #let go of the previous file first
+            #LightGBM only takes doubles from a Sequence
+            features = read_table(self.files[i], columns=self.columns).to_numpy(dtype=np.float64)
+            self._loaded = (i, features[self.rows[i]])
+        return self._loaded[1]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            i = int(np.searchsorted(self.ends, idx, side='right'))
+            return self._file(i)[idx - (self.ends[i] - len(self.rows[i]))]
+        if not isinstance(idx, slice):
+            raise TypeError("PartitionSequence index must be an integer or a slice")
+        start, stop, _ = idx.indices(len(self))
+        pieces = []
+        while start < stop:
+            i = int(np.searchsorted(self.ends, start, side='right'))
+            first = self.ends[i] - len(self.rows[i])
+            end = min(stop, self.ends[i])
+            pieces.append(self._file(i)[start - first:end - first])
+            start = end
+        return np.concatenate(pieces) if pieces else np.zeros((0, len(self.columns)))
+
+#train/validation Datasets over every partition file in directory. Each file's rows are split test_size at random
+#(seeded), so every partition shows up in both. Returns the Datasets and the sequences with their labels, for predicting
+def build_partitioned_datasets(directory, seed=SPLIT_SEED, test_size=TEST_SIZE, dataset_params=DATASET_PARAMS):
+    files = partition_files(directory)
+    if not files:
+        raise ValueError("no dataset files in " + directory)
+    columns = [c for c in table_columns(files[0]) if c not in NON_FEATURE_COLUMNS]
+
+    rng = np.random.default_rng(seed)
+    train_rows, val_rows, train_labels, val_labels = [], [], [], []
+    for path in files:
+        labels = read_table(path, columns=['precip_type'])['precip_type'].to_numpy(dtype=np.int8)
+        val = rng.random(len(labels)) < test_size
+        train_rows.append(np.flatnonzero(~val).astype(np.int32))
+        val_rows.append(np.flatnonzero(val).astype(np.int32))
+        train_labels.append(labels[~val])
+        val_labels.append(labels[val])
+
+    train_seq = PartitionSequence(files, train_rows, columns)
+    val_seq = PartitionSequence(files, val_rows, columns)
+    Y_train = np.concatenate(train_labels)
+    Y_val = np.concatenate(val_labels)
+    train_data = lgb.Dataset(train_seq, label=Y_train, feature_name=columns, params=dict(dataset_params))
+    test_data = lgb.Dataset(val_seq, label=Y_val, feature_name=columns, reference=train_data, params=dict(dataset_params))
+    return train_data, test_data, {'X_train': train_seq, 'X_val': val_seq, 'Y_train': Y_train, 'Y_val': Y_val}
+
+#predicts a PartitionSequence a batch at a time
+def predict_sequence(bst, seq):
+    return np.concatenate([bst.predict(seq[start:start + seq.batch_size]) for start in range(0, len(seq), seq.batch_size)])
+
+#peak resident memory of this process so far, in MB. None where the resource module doesn't exist (Windows)
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if os.uname().sysname == 'Darwin' else peak / 1024
 
 #choose training parameters
 # objective: binary choice, rain or snow
@@ -42,21 +210,42 @@ params = {
 
 #maximum number of rounds to train for. Thus, model will train between 40 and 100 rounds
 num_round = 100
-#train the model
-bst = lgb.train(params, train_data, num_round, valid_sets=[test_data])
 
-#make predictions on training and validation datasets
-y_train = bst.predict(X_train)
-y_val = bst.predict(X_val)
+def main():
+    #set this to a directory of dataset files (.parquet/.feather/.csv, e.g. one per station) to train on all of them
+    #without loading them into memory together, instead of the single file below
+    partition_dir = None
+
+    if partition_dir is not None:
+        train_data, test_data, split = build_partitioned_datasets(partition_dir)
+    else:
+        #dataset of format specified in combine_snd_sfc.py. The binned Datasets are cached in lgb_dataset_cache/,
+        #so rerunning with different training params skips reading and binning the data
+        train_data, test_data, split = build_datasets(os.path.join('.','ultimate_dataset2.csv'))
+
+    #train the model
+    bst = lgb.train(params, train_data, num_round, valid_sets=[test_data])
+
+    #make predictions on training and validation datasets
+    if partition_dir is not None:
+        y_train = predict_sequence(bst, split['X_train'])
+        y_val = predict_sequence(bst, split['X_val'])
+    else:
+        y_train = bst.predict(split['X_train'])
+        y_val = bst.predict(split['X_val'])
+
+    #compare to the classifiers, how well did we do? 
+    y_train_class = (y_train > 0.5).astype(int)
+    y_val_class = (y_val > 0.5).astype(int)
 
-#compare to the classifiers, how well did we do? 
-y_train_class = (y_train > 0.5).astype(int)
-y_val_class = (y_val > 0.5).astype(int)
+    #print results
+    print("Training ROC-AUC: ", ras(split['Y_train'], y_train))
+    print("Validation ROC-AUC: ", ras(split['Y_val'], y_val))
+    print("Peak memory (MB): ", peak_memory_mb())
 
-#print results
-print("Training ROC-AUC: ", ras(Y_train, y_train))
-print("Validation ROC-AUC: ", ras(Y_val, y_val))
+    #create, save, and then load a model
+    bst.save_model('lightgbm_model.txt') 
+    #loaded_model = lgb.Booster(model_file='lightgbm_model.txt') 
 
-#create, save, and then load a model
-bst.save_model('lightgbm_model.txt') 
-#loaded_model = lgb.Booster(model_file='lightgbm_model.txt') 
\ No newline at end of file
+if __name__=="__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,225 @@
+#evaluates a LightGBM model saved as text (e.g. lightgbm_model_v1.txt) with plain numpy, without the lightgbm library
+#the trees are parsed into flat arrays: every internal node of every tree gets a row in split_feature/threshold/
+#decision_type/left/right, and children point either at another node (>= 0) or at a leaf (~leaf, so < 0).
+#predicting works a batch of rows at a time over all trees at once. First every split of every tree is decided for
+#every row in one array operation, then each row's leaf in each tree is found from those decisions:
+# small trees (like the 5 leaf trees of lightgbm_model_v1.txt): the decisions of a tree's splits are packed into the bits
+#   of a number, which indexes a table of the leaf every combination of decisions ends up in
+# bigger trees: level by level from the deepest one, each node takes the value of the child its rows go to, so after
+#   the top level each tree's root holds the leaf value every row ends up in
+#the leaf values are summed over the trees and a binary model's sigmoid is applied. Matches Booster.predict for
+#numerical splits
+
+import numpy as np
+
+#decision_type bits, as in LightGBM's tree.h
+CATEGORICAL_MASK = 1
+DEFAULT_LEFT_MASK = 2
+#missing value handling, in bits 2-3 of decision_type
+MISSING_NONE = 0
+MISSING_ZERO = 1
+MISSING_NAN = 2
+#LightGBM treats anything this close to 0 as zero
+ZERO_THRESHOLD = 1e-35
+
+#trees with at most this many splits are evaluated with a table of 2**splits leaves each
+TABLE_MAX_NODES = 8
+#rows per batch when predicting. Each batch works on (splits x rows) arrays, small batches keep them in cache
+PREDICT_BATCH_ROWS = 1024
+
+#reads the header and the Tree= blocks of a text model into {key: value} dicts
+def _read_model_text(path):
+    header, trees, current = {}, [], None
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line == 'end of trees':
+                break
+            if line.startswith('Tree='):
+                current = {}
+                trees.append(current)
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                (header if current is None else current)[key] = value
+        else:
+            #lightgbm ends every model with this line, so a file still being written doesn't have it yet
+            raise ValueError(f"{path} has no 'end of trees', incomplete model file?")
+    return header, trees
+
+def _floats(tree, key):
+    return np.array(tree[key].split(), dtype=np.float64) if tree.get(key) else np.zeros(0)
+
+def _ints(tree, key):
+    return np.array(tree[key].split(), dtype=np.int64) if tree.get(key) else np.zeros(0, dtype=np.int64)
+
+class NumpyBooster:
+    def __init__(self, model_file):
+        header, trees = _read_model_text(model_file)
+        if int(header.get('num_class', 1)) != 1:
+            raise ValueError("only single-output models are supported")
+        self.num_features = int(header['max_feature_idx']) + 1
+        self.feature_names = header.get('feature_names', '').split()
+        objective = header.get('objective', '').split()
+        #binary models turn the raw score into a probability with a sigmoid of this slope, anything else is left raw
+        self.sigmoid = None
+        if objective and objective[0] == 'binary':
+            self.sigmoid = next((float(o.split(':')[1]) for o in objective[1:] if o.startswith('sigmoid:')), 1.0)
+
+        features, thresholds, decisions, lefts, rights, leaf_values, roots, sizes = [], [], [], [], [], [], [], []
+        node_offset = leaf_offset = 0
+        for tree in trees:
+            if int(tree.get('num_cat', 0)) > 0:
+                raise ValueError("categorical splits are not supported")
+            if tree.get('is_linear', '0') != '0':
+                raise ValueError("linear trees (linear_tree=True) are not supported")
+            num_leaves = int(tree['num_leaves'])
+            if num_leaves == 1:
+                #a tree without splits, every row lands on its one leaf
+                roots.append(~leaf_offset)
+            else:
+                left, right = _ints(tree, 'left_child'), _ints(tree, 'right_child')
+                #shift children to their position in the flat arrays, leaves are stored as ~leaf
+                lefts.append(np.where(left >= 0, left + node_offset, ~(~left + leaf_offset)))
+                rights.append(np.where(right >= 0, right + node_offset, ~(~right + leaf_offset)))
+                features.append(_ints(tree, 'split_feature'))
+                thresholds.append(_floats(tree, 'threshold'))
+                decisions.append(_ints(tree, 'decision_type'))
+                roots.append(node_offset)
+                node_offset += num_leaves - 1
+            leaf_values.append(_floats(tree, 'leaf_value'))
+            leaf_offset += num_leaves
+            sizes.append(num_leaves - 1)
+
+        concat = lambda parts, dtype: np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+        self.split_feature = concat(features, np.int32)
+        self.threshold = concat(thresholds, np.float64)
+        decision_type = concat(decisions, np.int32)
+        self.default_left = (decision_type & DEFAULT_LEFT_MASK) != 0
+        self.missing_type = (decision_type >> 2) & 3
+        self.left_child = concat(lefts, np.int32)
+        self.right_child = concat(rights, np.int32)
+        self.leaf_value = concat(leaf_values, np.float64)
+        self.roots = np.array(roots, dtype=np.int32)
+
+        self._build_ranks()
+        width = max(sizes, default=0)
+        if width <= TABLE_MAX_NODES:
+            self._build_tables(width, sizes)
+        else:
+            self._tables = None
+            self._build_levels()
+
+    def num_trees(self):
+        return len(self.roots)
+
+    #the splits on a feature only compare it with a handful of thresholds, so every value is first turned into its rank
+    #among that feature's sorted thresholds, and a split sends a row left when the rank is at most that of its threshold.
+    #Then deciding all the splits compares small integers instead of doubles
+    def _build_ranks(self):
+        self._cuts = []
+        ranks = np.zeros(len(self.split_feature), dtype=np.int64)
+        for feature in range(self.num_features):
+            nodes = np.flatnonzero(self.split_feature == feature)
+            cuts = np.unique(self.threshold[nodes])
+            ranks[nodes] = np.searchsorted(cuts, self.threshold[nodes])
+            self._cuts.append(cuts)
+        self._rank_dtype = np.min_scalar_type(max(len(cuts) for cuts in self._cuts))
+        self._split_rank = ranks.astype(self._rank_dtype)[:, None]
+        #splits that send zeros or missing values their own way are decided from the values themselves
+        self._missing_nodes = np.flatnonzero(self.missing_type != MISSING_NONE)
+
+    #a tree's table maps the bits of its decisions (bit k set when its k-th split sends the row left) to the leaf value
+    #the row ends up in. Trees with fewer splits than width fill the rest with split 0, whose bits the table ignores
+    def _build_tables(self, width, sizes):
+        codes = np.arange(2**width)
+        self._table_nodes = np.zeros((width, len(self.roots)), dtype=np.intp)
+        self._tables = np.empty((len(self.roots), len(codes)))
+        for tree, (root, size) in enumerate(zip(self.roots, sizes)):
+            if size == 0:
+                self._tables[tree] = self.leaf_value[~root]
+                continue
+            self._table_nodes[:size, tree] = np.arange(root, root + size)
+            node = np.full(len(codes), root)
+            while (node >= 0).any():
+                inner = node >= 0
+                left = (codes[inner] >> (node[inner] - root)) & 1 == 1
+                node[inner] = np.where(left, self.left_child[node[inner]], self.right_child[node[inner]])
+            self._tables[tree] = self.leaf_value[~node]
+        self._table_nodes = self._table_nodes.ravel()
+        self._table_offsets = (np.arange(len(self.roots)) * len(codes))[:, None]
+
+    #groups the internal nodes by depth, deepest first. For each level and side, the positions whose child is a leaf
+    #(with the leaf values) and the positions whose child is a node from the level below (with the nodes)
+    def _build_levels(self):
+        depth = np.zeros(len(self.split_feature), dtype=np.int32)
+        for node in range(len(depth)): #children always come after their parent within a tree
+            for child in (self.left_child[node], self.right_child[node]):
+                if child >= 0:
+                    depth[child] = depth[node] + 1
+        self._levels = []
+        for d in range(depth.max(initial=-1), -1, -1):
+            nodes = np.flatnonzero(depth == d)
+            level = {'nodes': nodes}
+            for side, children in (('left', self.left_child[nodes]), ('right', self.right_child[nodes])):
+                leaf = children < 0
+                level[side] = (np.flatnonzero(leaf), self.leaf_value[~children[leaf]][:, None],
+                               np.flatnonzero(~leaf), children[~leaf])
+            self._levels.append(level)
+        #trees without splits just add their leaf value
+        self._constant = self.leaf_value[~self.roots[self.roots < 0]].sum()
+
+    #which way every split sends every row, as a (splits x rows) boolean array, True for left
+    def _decisions(self, data):
+        columns = data.T
+        #NaN counts as 0, except for the splits with missing value handling below
+        filled = np.where(np.isnan(columns), 0.0, columns)
+        ranks = np.empty(columns.shape, dtype=self._rank_dtype)
+        for feature, cuts in enumerate(self._cuts):
+            ranks[feature] = np.searchsorted(cuts, filled[feature])
+        go_left = ranks[self.split_feature] <= self._split_rank
+        if len(self._missing_nodes):
+            nodes = self._missing_nodes
+            value = columns[self.split_feature[nodes]]
+            missing = self.missing_type[nodes][:, None]
+            nan = np.isnan(value)
+            value = np.where(nan & (missing != MISSING_NAN), 0.0, value)
+            to_default = ((missing == MISSING_ZERO) & (np.abs(value) <= ZERO_THRESHOLD)) | ((missing == MISSING_NAN) & nan)
+            go_left[nodes] = np.where(to_default, self.default_left[nodes][:, None], go_left[nodes])
+        return go_left
+
+    #sum of the leaf values each row ends up in, over all trees
+    def _raw_score(self, data):
+        go_left = self._decisions(data)
+        if self._tables is not None:
+            bits = go_left[self._table_nodes].reshape(-1, len(self.roots), len(data)).view(np.uint8)
+            code = np.zeros((len(self.roots), len(data)), dtype=np.intp)
+            for k, bit in enumerate(bits):
+                code |= bit.astype(np.intp) << k
+            #summing over the first axis adds the trees in order for every row, as LightGBM does
+            return self._tables.take(code + self._table_offsets).sum(axis=0)
+        node_value = np.empty(go_left.shape)
+        for level in self._levels:
+            chosen = []
+            for side in ('left', 'right'):
+                leaf_rows, leaf_values, node_rows, child_nodes = level[side]
+                values = np.empty((len(level['nodes']), len(data)))
+                values[leaf_rows] = leaf_values
+                values[node_rows] = node_value[child_nodes]
+                chosen.append(values)
+            node_value[level['nodes']] = np.where(go_left[level['nodes']], chosen[0], chosen[1])
+        return node_value[self.roots[self.roots >= 0]].sum(axis=0) + self._constant
+
+    #same as lgb.Booster.predict: probabilities for a binary model (raw scores with raw_score=True)
+    #data is an N x num_features array or DataFrame
+    def predict(self, data, raw_score=False):
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        if data.shape[1] != self.num_features:
+            raise ValueError(f"model has {self.num_features} features, data has {data.shape[1]}")
+        raw = np.zeros(len(data))
+        for start in range(0, len(data), PREDICT_BATCH_ROWS):
+            raw[start:start + PREDICT_BATCH_ROWS] = self._raw_score(data[start:start + PREDICT_BATCH_ROWS])
+        if raw_score or self.sigmoid is None:
+            return raw
+        return 1.0 / (1.0 + np.exp(-self.sigmoid * raw))
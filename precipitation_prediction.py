@@ -1,15 +1,16 @@
-from siphon.simplewebservice.wyoming import WyomingUpperAir
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 import numpy as np
 from time import sleep
-import pandas as pd
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
-from urllib.error import HTTPError
-import lightgbm as lgb
+import random
+import os
+import sys
+import csv
+import json
+import argparse
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from numpy_gbm import NumpyBooster
 
 # General format
 # request sounding data from various stations around the country for the most recent time
@@ -17,12 +18,20 @@ import lightgbm as lgb
 # run ML model on each sounding location to get prob of precip
 # associate prob with a lat-lon location, create list of these
 # plot each of these locations with a color on the map
+#
+# run it as a script, see main() for the options. Only numpy is imported up front: siphon/requests/pandas are imported
+# when soundings are fetched and cartopy/matplotlib only when plotting, so a headless run (--output) never pays for the
+# plotting libraries. The model is evaluated with numpy_gbm, so lightgbm isn't needed at all
 
-#load our model
-loaded_gbm = lgb.Booster(model_file='lightgbm_model_v1.txt')
+MODEL_FILE = 'lightgbm_model_v1.txt'
 sounding_ids = ["APX", "INL","MPX","DVN","ILX","ILN","DTX", "KSGF", "KGRB", "KTOP"]
 COLOR_MAP = {'rain': 'green', 'snow': 'blue', 'mixed': 'purple'}
 
+#load our model, once, the first time it's needed
+@lru_cache(maxsize=None)
+def load_model(model_file=MODEL_FILE):
+    return NumpyBooster(model_file)
+
 #gets nearest datetime
 def nearest_sounding_time():
     utc_tz = ZoneInfo("Europe/London")
@@ -40,71 +49,226 @@ def nearest_sounding_time():
 
     return datetime(now_year, now_month, now_day, use_hour)
 
-#takes a list of station ids, returns relevant info for each
-def get_observed_sounding_data(obsdate, stations):
+#fetching soundings. Stations are requested in parallel (FETCH_WORKERS at a time, the Wyoming server throttles heavy users),
+#every request has a timeout, and a busy server or a dropped connection is retried with exponential backoff
+#(BACKOFF_BASE, 2x, 4x... seconds, capped at BACKOFF_MAX, with some jitter) up to FETCH_RETRIES times.
+#A station that has no sounding or keeps failing is reported and left out, it doesn't hold up the others
+WYOMING_URL = 'http://weather.uwyo.edu/wsgi'
+FETCH_WORKERS = 4
+FETCH_TIMEOUT = 30
+FETCH_RETRIES = 4
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+#HTTP status codes that mean "try again later" rather than "there's nothing here"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+#WyomingUpperAir with a configurable server (e.g. a local stand-in for testing) and a timeout on every request
+#the class is built on first use, so siphon is only imported when something is fetched
+@lru_cache(maxsize=None)
+def _endpoint_class():
+    import requests
+    from siphon.simplewebservice.wyoming import WyomingUpperAir
+    from siphon.http_util import HTTPEndPoint
+
+    class WyomingEndpoint(WyomingUpperAir):
+        def __init__(self, base_url=WYOMING_URL, timeout=FETCH_TIMEOUT):
+            self.timeout = timeout
+            HTTPEndPoint.__init__(self, base_url)
+
+        #same as HTTPEndPoint.get, plus the timeout and the response kept on the error so its status can be checked
+        def get(self, path, params=None):
+            resp = self._session.get(path, params=params, timeout=self.timeout)
+            if resp.status_code != 200:
+                raise requests.HTTPError(f'Error accessing {resp.request.url}\nServer Error ({resp.status_code}: {resp.reason})', response=resp)
+            return resp
+
+    return WyomingEndpoint
+
+def WyomingEndpoint(base_url=WYOMING_URL, timeout=FETCH_TIMEOUT):
+    return _endpoint_class()(base_url, timeout)
+
+#whether a failed request is worth retrying. siphon turns HTTP errors into ValueErrors, which is also what it raises
+#when the station simply has no sounding for that time
+def _retryable(error):
+    import requests
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    cause = error.__cause__ if isinstance(error, ValueError) else error
+    return isinstance(cause, requests.HTTPError) and cause.response is not None and cause.response.status_code in RETRY_STATUS
+
+#on-disk cache of fetched soundings, one parquet file per (station, valid time), so reruns and backfills don't hit the server
+#a sounding fetched before its cycle closed (less than CYCLE_HOURS after its valid time) can still change as the server
+#fills it in, so it is only used for RESPONSE_CACHE_TTL seconds after it was fetched and then fetched again, even once
+#the cycle is over. Soundings fetched after the cycle closed are kept for good, until the cache grows past
+#RESPONSE_CACHE_MAX_BYTES and the least recently used soundings are evicted
+RESPONSE_CACHE_DIR = 'sounding_response_cache'
+RESPONSE_CACHE_TTL = 15 * 60
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024**2
+CYCLE_HOURS = 12
+
+def _response_cache_path(cache_dir, obsdate, station):
+    return os.path.join(cache_dir, f"{station}_{obsdate:%Y%m%d%H}.parquet")
+
+#when the cycle of a sounding is over, as a unix timestamp. Sounding times are naive datetimes in UTC
+def cycle_close_time(obsdate):
+    return (obsdate + timedelta(hours=CYCLE_HOURS)).replace(tzinfo=timezone.utc).timestamp()
+
+#the cached sounding, or None if there isn't one (or it was fetched before its cycle closed and is older than the TTL)
+def load_cached_response(cache_dir, obsdate, station):
+    path = _response_cache_path(cache_dir, obsdate, station)
+    try:
+        fetched = os.path.getmtime(path)
+        if fetched < cycle_close_time(obsdate):
+            #entries fetched during their cycle are never touched on reads, so their modification time is when they were fetched
+            if datetime.now().timestamp() - fetched > RESPONSE_CACHE_TTL:
+                return None
+        else:
+            #mark as recently used for eviction, this keeps the modification time after the cycle closed
+            os.utime(path)
+        import pandas as pd
+        return pd.read_parquet(path)
+    except FileNotFoundError:
+        return None
+
+#written to a temporary file first, so a reader never sees half a file
+def store_cached_response(cache_dir, obsdate, station, df):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _response_cache_path(cache_dir, obsdate, station)
+    tmp = path + '.tmp-' + str(os.getpid()) + '-' + station
+    df.to_parquet(tmp)
+    os.replace(tmp, path)
+
+#removes the least recently used soundings until the cache is under max_bytes, returns the size left
+def evict_response_cache(cache_dir, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.parquet'):
+            entries.append((os.path.getmtime(path), path, os.path.getsize(path)))
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+    return total
+
+#fetches one station's sounding, returns (dataframe, None) or (None, why it failed)
+#with a cache_dir, a cached copy is used when there is one and a fresh download is stored
+def fetch_sounding(obsdate, station, base_url=WYOMING_URL, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES, cache_dir=None):
+    if cache_dir is not None:
+        df = load_cached_response(cache_dir, obsdate, station)
+        if df is not None:
+            return df, None
+
+    endpoint = WyomingEndpoint(base_url, timeout)
+    for attempt in range(retries + 1):
+        try:
+            df = endpoint._get_data(obsdate, station)
+            break
+        except Exception as e: #a bad response from one station shouldn't take the whole run down
+            reason = str(e.__cause__ or e) #siphon's ValueErrors carry the HTTP error as their cause
+            if not _retryable(e):
+                return None, reason
+            if attempt == retries:
+                return None, f"gave up after {retries + 1} attempts: {reason}"
+            sleep(min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) * random.uniform(0.5, 1.5))
+
+    if cache_dir is not None:
+        store_cached_response(cache_dir, obsdate, station, df)
+    return df, None
+
+#fetches every station at once, returns ({station: dataframe}, {station: why it failed})
+def fetch_soundings(obsdate, stations, base_url=WYOMING_URL, workers=FETCH_WORKERS, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES, cache_dir=None):
+    soundings, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda station: fetch_sounding(obsdate, station, base_url, timeout, retries, cache_dir), stations)
+        for station, (df, error) in zip(stations, results):
+            if df is None:
+                failures[station] = error
+            else:
+                soundings[station] = df
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        evict_response_cache(cache_dir)
+    return soundings, failures
+
+#pulls lat, lon and the surface, 925 and 850 temperature/dewpoint out of one sounding, None if it doesn't reach both levels
+def sounding_features(df):
+    lat, lon = df['latitude'].iloc[0], df['longitude'].iloc[0]
+    pressures = df['pressure'].values
+    max_pres = max(pressures)
+    if not (925 in pressures and 850 in pressures):
+        return None
+    sfc_df = df.where(df['pressure'] == max_pres).dropna(subset=('temperature', 'dewpoint'), how='all').reset_index(drop=True).iloc[0]
+    df925 = df.where(df['pressure'] == 925.0).dropna(subset=('temperature', 'dewpoint'), how='all').reset_index(drop=True).iloc[0]
+    df850 = df.where(df['pressure'] == 850.0).dropna(subset=('temperature', 'dewpoint'), how='all').reset_index(drop=True).iloc[0]
+    return [lat, lon, sfc_df['temperature'], sfc_df['dewpoint'], df925['temperature'], df925['dewpoint'],df850['temperature'],df850['dewpoint']]
+
+#takes a list of station ids, returns relevant info for each. Options (base_url, workers, timeout, retries, cache_dir) go to fetch_soundings
+def get_observed_sounding_data(obsdate, stations, **fetch_options):
+    soundings, failures = fetch_soundings(obsdate, stations, **fetch_options)
+    for station, error in failures.items():
+        print(f"{station}: no sounding ({error})", file=sys.stderr)
+
     all_soundings = []
     for station in stations:
-        gotsound = True
-        nosound = True
-        while gotsound:
-            try:
-                df = WyomingUpperAir.request_data(obsdate, station)
-                gotsound = False
-                nosound = False
-            except HTTPError:
-                sleep(1)
-            except ValueError as e:
-                print(e)
-                gotsound = False
-                continue
-        if nosound:
-            continue
-        lat, lon = df['latitude'].iloc[0], df['longitude'].iloc[0]
-        pressures = df['pressure'].values
-        max_pres = max(pressures)
-        good_levels = False
-        if 925 in pressures and 850 in pressures:
-            good_levels = True
-        if good_levels: 
-            sfc_df = df.where(df['pressure'] == max_pres).dropna(subset=('temperature', 'dewpoint'), how='all').reset_index(drop=True).iloc[0]
-            df925 = df.where(df['pressure'] == 925.0).dropna(subset=('temperature', 'dewpoint'), how='all').reset_index(drop=True).iloc[0]
-            df850 = df.where(df['pressure'] == 850.0).dropna(subset=('temperature', 'dewpoint'), how='all').reset_index(drop=True).iloc[0]
-            relevant_info = [lat, lon, sfc_df['temperature'], sfc_df['dewpoint'], df925['temperature'], df925['dewpoint'],df850['temperature'],df850['dewpoint']]
-            all_soundings.append(relevant_info)
-        else:
-            continue
+        if station in soundings:
+            relevant_info = sounding_features(soundings[station])
+            if relevant_info is not None:
+                all_soundings.append(relevant_info)
 
-    #returns list of dataframes
+    #returns list of [lat, lon, sfc t, sfc td, t925, td925, t850, td850]
     return all_soundings
 
-#takes a list of obs and makes a prediction using lightgbm on them
-def predict_precip(obs_list):
-    all_predictions = [] #list of lists
-    for ob in obs_list:
-        lat = float(ob[0])
-        lon = float(ob[1])
-        sfc_t = float(ob[2])
-        sfc_td = float(ob[3])
-        t925 = float(ob[4])
-        td925 = float(ob[5])
-        t850 = float(ob[6])
-        td850 = float(ob[7])
-        predict_df = pd.DataFrame({'sfct':[sfc_t], 'sfctd':[sfc_td], 't925':[t925], 'td925':[td925], 't850':[t850], 'td850':[td850]})
-        prediction = loaded_gbm.predict(predict_df)[0]
-        print(ob)
-        print(prediction)
-        #convert to something useable
-        if prediction > 0.6:
-            prediction = 'snow'
-        elif prediction < 0.4:
-            prediction = 'rain'
-        else:
-            prediction = 'mixed'
-        all_predictions.append([lat, lon, prediction])
+#probability thresholds for calling a prediction snow (above SNOW_THRESHOLD) or rain (below RAIN_THRESHOLD), mixed in between
+SNOW_THRESHOLD = 0.6
+RAIN_THRESHOLD = 0.4
+#precip type names, indexed by the class codes in the predictions
+PRECIP_CLASSES = np.array(['rain', 'mixed', 'snow'])
+#one prediction: where it is, the model's probability of snow and the class code (0 rain, 1 mixed, 2 snow)
+PREDICTION_DTYPE = np.dtype([('lat', 'f4'), ('lon', 'f4'), ('probability', 'f4'), ('precip_type', 'i1')])
+
+#turns snow probabilities into class codes (see PRECIP_CLASSES)
+def classify_probabilities(probabilities):
+    probabilities = np.asarray(probabilities)
+    codes = np.ones(probabilities.shape, dtype=np.int8)
+    codes[probabilities < RAIN_THRESHOLD] = 0
+    codes[probabilities > SNOW_THRESHOLD] = 2
+    return codes
+
+#predicts a whole batch of soundings with a single call to the model
+#data is either an N x 6 array of features (sfc t, sfc td, t925, td925, t850, td850) with lats/lons given separately,
+#or an N x 8 array / list of soundings as returned by get_observed_sounding_data (lat, lon, then the 6 features)
+#returns a structured array of PREDICTION_DTYPE, one entry per row
+def predict_batch(data, lats=None, lons=None, model=None):
+    model = load_model() if model is None else model
+    data = np.asarray(data, dtype=np.float64)
+    if data.size == 0:
+        return np.zeros(0, dtype=PREDICTION_DTYPE)
+    data = data.reshape(len(data), -1)
+    if data.shape[1] == 8:
+        lats, lons, data = data[:, 0], data[:, 1], data[:, 2:]
 
-    return all_predictions
+    predictions = np.zeros(len(data), dtype=PREDICTION_DTYPE)
+    predictions['lat'] = np.nan if lats is None else lats
+    predictions['lon'] = np.nan if lons is None else lons
+    probabilities = model.predict(data)
+    predictions['probability'] = probabilities
+    predictions['precip_type'] = classify_probabilities(probabilities)
+    return predictions
+
+#takes a list of obs and makes a prediction using lightgbm on them, returns [lat, lon, precip type name] for each
+def predict_precip(obs_list):
+    predictions = predict_batch(obs_list)
+    names = PRECIP_CLASSES[predictions['precip_type']]
+    return [[float(lat), float(lon), str(name)] for lat, lon, name in zip(predictions['lat'], predictions['lon'], names)]
         
 def plot_predictions(pred_list, time):
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    import matplotlib.pyplot as plt
+    import matplotlib.lines as mlines
+
     plt.figure(figsize=(10, 8))
     ax = plt.axes(projection=ccrs.PlateCarree())
 
@@ -144,10 +308,58 @@ def plot_predictions(pred_list, time):
     plt.title(f"Sounding Analysis for {time.year}-{time.month}-{time.day} {time.hour} UTC")
     plt.show()
 
-#just running all the functions
-time = nearest_sounding_time()
-#time = datetime(2025, 11, 18, 0)
-all_stats = get_observed_sounding_data(time, sounding_ids)  
-predictions = predict_precip(all_stats) 
+#writes predictions to a .json or .csv file, or as JSON to stdout for "-"
+def write_predictions(predictions, obsdate, output):
+    names = PRECIP_CLASSES[predictions['precip_type']]
+    records = [{'time': obsdate.strftime("%Y-%m-%dT%H:00:00"), 'lat': round(float(lat), 4), 'lon': round(float(lon), 4),
+                'probability': round(float(probability), 4), 'precip_type': str(name)}
+               for lat, lon, probability, name in zip(predictions['lat'], predictions['lon'], predictions['probability'], names)]
+    if output.endswith('.csv'):
+        with open(output, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['time', 'lat', 'lon', 'probability', 'precip_type'])
+            writer.writeheader()
+            writer.writerows(records)
+    elif output == '-':
+        json.dump(records, sys.stdout, indent=1)
+        print()
+    else:
+        with open(output, 'w') as file:
+            json.dump(records, file, indent=1)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Predict precip type (rain/mixed/snow) at sounding sites")
+    parser.add_argument('--time', type=datetime.fromisoformat,
+                        help="sounding time in UTC, e.g. 2025-11-18T00 (default: the latest 00z/12z)")
+    parser.add_argument('--stations', default=",".join(sounding_ids), help="comma separated station ids")
+    parser.add_argument('--output', help="write predictions to a .json or .csv file (- for JSON on stdout) instead of plotting")
+    parser.add_argument('--plot', action='store_true', help="plot the map even when --output is given")
+    parser.add_argument('--model', default=MODEL_FILE, help="model file")
+    parser.add_argument('--server', help="predict through a running prediction_server.py at this url instead of loading the model")
+    parser.add_argument('--cache-dir', default=RESPONSE_CACHE_DIR, help="sounding cache directory ('' to disable)")
+    parser.add_argument('--base-url', default=WYOMING_URL, help="sounding server")
+    parser.add_argument('--workers', type=int, default=FETCH_WORKERS, help="stations fetched at once")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    #just running all the functions
+    time = args.time or nearest_sounding_time()
+    stations = [station.strip() for station in args.stations.split(",") if station.strip()]
+    all_stats = get_observed_sounding_data(time, stations, base_url=args.base_url, workers=args.workers,
+                                           cache_dir=args.cache_dir or None)
+    if args.server:
+        from prediction_server import RemoteModel
+        model = RemoteModel(args.server)
+    else:
+        model = load_model(args.model)
+    predictions = predict_batch(all_stats, model=model)
+
+    if args.output:
+        write_predictions(predictions, time, args.output)
+    if args.plot or not args.output:
+        names = PRECIP_CLASSES[predictions['precip_type']]
+        plot_predictions([[float(lat), float(lon), str(name)] for lat, lon, name in zip(predictions['lat'], predictions['lon'], names)], time)
+    return 0
 
-plot_predictions(predictions, time)
+if __name__=="__main__":
+    main()
@@ -0,0 +1,315 @@
+#long running prediction service: keeps the model loaded and answers predictions over HTTP on localhost, so the station
+#script, wrf_precip.py and backfills can share one warm model instead of each loading lightgbm_model_v1.txt again
+#
+# POST /predict  body is the rows to predict, N x 6 features (sfc t, sfc td, t925, td925, t850, td850), either
+#                raw little-endian float64 (Content-Type: application/octet-stream, with the number of columns in an
+#                X-Num-Features header), answered with the float64 probabilities,
+#                or JSON {"rows": [[...], ...]}, answered with {"probabilities": [...]}
+# GET /stats     request/row/batch counts, batch sizes, latency percentiles and model reloads, as JSON
+#
+#requests are queued and a single worker predicts whatever is waiting in one model call (a micro-batch, up to
+#MAX_BATCH_ROWS rows, waiting up to BATCH_WAIT seconds for more to arrive), so many small callers cost about as much as one
+#big one. The model file is reloaded when it changes, write the new model somewhere else and os.replace it over the old one
+#
+#run it with python prediction_server.py (--help for the options), and use RemoteModel(url) in place of a loaded model
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import http.client
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+import numpy as np
+from numpy_gbm import NumpyBooster
+
+HOST = '127.0.0.1'
+PORT = 8765
+MODEL_FILE = 'lightgbm_model_v1.txt'
+#most rows predicted in one model call, and how long the worker waits for more requests to fill a batch
+MAX_BATCH_ROWS = 65536
+BATCH_WAIT = 0.001
+#how often (seconds) the model file is checked for changes
+RELOAD_CHECK_INTERVAL = 1.0
+#latency and batch size percentiles are over this many of the latest requests/batches
+STATS_WINDOW = 10000
+#bigger request bodies are refused
+MAX_REQUEST_BYTES = 64 * 1024**2
+
+#counters for /stats, updated by the batching worker
+class ServingStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = self.rows = self.batches = self.errors = self.reloads = 0
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.batch_rows = deque(maxlen=STATS_WINDOW)
+
+    def record_batch(self, latencies, rows, failed=False):
+        with self.lock:
+            self.batches += 1
+            self.requests += len(latencies)
+            self.rows += rows
+            self.errors += len(latencies) if failed else 0
+            self.latencies.extend(latencies)
+            self.batch_rows.append(rows)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_rows = np.array(self.batch_rows)
+            stats = {'uptime_s': round(time.time() - self.started, 1), 'requests': self.requests, 'rows': self.rows,
+                     'batches': self.batches, 'errors': self.errors, 'reloads': self.reloads}
+        stats['requests_per_batch'] = round(stats['requests'] / stats['batches'], 2) if stats['batches'] else None
+        if len(batch_rows):
+            stats['batch_rows'] = {'mean': round(float(batch_rows.mean()), 1), 'max': int(batch_rows.max())}
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            stats['latency_ms'] = {'p50': round(p50, 3), 'p95': round(p95, 3), 'p99': round(p99, 3),
+                                   'max': round(float(latencies.max()), 3)}
+        return stats
+
+#keeps the model loaded and predicts queued requests in batches, on its own thread
+class MicroBatcher:
+    def __init__(self, model_file=MODEL_FILE, max_batch_rows=MAX_BATCH_ROWS, batch_wait=BATCH_WAIT,
+                 reload_interval=RELOAD_CHECK_INTERVAL):
+        self.model_file = model_file
+        self.max_batch_rows = max_batch_rows
+        self.batch_wait = batch_wait
+        self.reload_interval = reload_interval
+        self.stats = ServingStats()
+        self.queue = queue.Queue()
+        #the first load has to work, later reloads keep the old model if the new file can't be read
+        self.model = NumpyBooster(model_file)
+        self.model_stamp = self._stamp()
+        self.last_check = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def num_features(self):
+        return self.model.num_features
+
+    def _stamp(self):
+        st = os.stat(self.model_file)
+        return st.st_mtime_ns, st.st_size
+
+    #reloads the model if its file changed since it was loaded
+    def _check_reload(self):
+        now = time.monotonic()
+        if now - self.last_check < self.reload_interval:
+            return
+        self.last_check = now
+        try:
+            stamp = self._stamp()
+            if stamp == self.model_stamp:
+                return
+            model = NumpyBooster(self.model_file)
+        except Exception as e:
+            #the file is missing or half written, try again at the next check
+            print(f"not reloading {self.model_file}: {e}", file=sys.stderr)
+            return
+        self.model, self.model_stamp = model, stamp
+        with self.stats.lock:
+            self.stats.reloads += 1
+        print(f"reloaded {self.model_file} ({model.num_trees()} trees)", file=sys.stderr)
+
+    #queues N x num_features rows, the future gets their probabilities
+    def submit(self, rows):
+        future = Future()
+        self.queue.put((rows, future, time.perf_counter()))
+        return future
+
+    def predict(self, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        #reshaping would quietly cut rows of the wrong width into rows of the right one
+        if rows.ndim != 2 or rows.shape[1] != self.num_features:
+            raise ValueError(f"expected N x {self.num_features} rows, got an array of shape {rows.shape}")
+        return self.submit(rows).result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    #takes whatever is queued, and whatever arrives within batch_wait, up to max_batch_rows
+    def _next_batch(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch, rows = [first], len(first[0])
+        deadline = time.perf_counter() + self.batch_wait
+        while rows < self.max_batch_rows:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.perf_counter(), 0)) if self.batch_wait else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None) #stop after this batch
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._check_reload()
+            sizes = [len(rows) for rows, _, _ in batch]
+            try:
+                probabilities = self.model.predict(np.concatenate([rows for rows, _, _ in batch]))
+            except Exception as e:
+                done = time.perf_counter()
+                self.stats.record_batch([done - queued for _, _, queued in batch], sum(sizes), failed=True)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            self.stats.record_batch([done - queued for _, _, queued in batch], sum(sizes))
+            for part, (_, future, _) in zip(np.split(probabilities, np.cumsum(sizes)[:-1]), batch):
+                future.set_result(part)
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    #keep-alive, so a client can send many requests over one connection
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = self.server.batcher.stats.snapshot()
+            stats['model_file'] = self.server.batcher.model_file
+            self._send(200, stats)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_REQUEST_BYTES:
+            self.close_connection = True
+            self._send(413, {'error': f"request bodies are limited to {MAX_REQUEST_BYTES} bytes"})
+            return
+        body = self.rfile.read(length)
+        binary = self.headers.get('Content-Type', '').startswith('application/octet-stream')
+        num_features = self.server.batcher.num_features
+        try:
+            if binary:
+                #a flat buffer doesn't say how wide its rows are, so the client has to, or rows of the wrong width
+                #would just be cut up differently
+                sent = self.headers.get('X-Num-Features')
+                if sent is None or int(sent) != num_features:
+                    raise ValueError(f"X-Num-Features is {sent}, the model has {num_features} features")
+                if length % (8 * num_features):
+                    raise ValueError(f"body is not a whole number of {num_features}-feature float64 rows")
+                rows = np.frombuffer(body, dtype='<f8').reshape(-1, num_features)
+            else:
+                rows = np.asarray(json.loads(body)['rows'], dtype=np.float64)
+                if rows.size == 0:
+                    rows = rows.reshape(0, num_features)
+                if rows.ndim != 2 or rows.shape[1] != num_features:
+                    raise ValueError(f"rows must be lists of {num_features} features")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        try:
+            probabilities = self.server.batcher.submit(rows).result()
+        except Exception as e:
+            self._send(500, {'error': str(e)})
+            return
+        if binary:
+            self._send(200, probabilities.astype('<f8').tobytes(), 'application/octet-stream')
+        else:
+            self._send(200, {'probabilities': probabilities.tolist()})
+
+    #one line per request would flood the log, the counters are in /stats
+    def log_message(self, format, *args):
+        pass
+
+#stands in for a loaded model (e.g. predict_batch(data, model=RemoteModel(url))), predicting through a running server.
+#Keeps its connection open between calls, so use one per thread
+class RemoteModel:
+    def __init__(self, url=f'http://{HOST}:{PORT}', timeout=30):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.connection = None
+
+    def _post(self, body, num_features):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.connection.request('POST', '/predict', body=body, headers={'Content-Type': 'application/octet-stream',
+                                                                         'X-Num-Features': str(num_features)})
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def predict(self, data):
+        data = np.asarray(data, dtype='<f8')
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        if data.ndim != 2:
+            raise ValueError(f"expected rows of features, got an array of shape {data.shape}")
+        #the server refuses bodies over MAX_REQUEST_BYTES, so big arrays go in several requests
+        chunk_rows = max(MAX_REQUEST_BYTES // (8 * max(data.shape[1], 1)), 1)
+        parts = [self._predict_chunk(data[start:start + chunk_rows]) for start in range(0, max(len(data), 1), chunk_rows)]
+        return np.concatenate(parts)
+
+    def _predict_chunk(self, data):
+        body = np.ascontiguousarray(data).tobytes()
+        try:
+            status, reply = self._post(body, data.shape[1])
+        except (ConnectionError, http.client.HTTPException):
+            #the server closed the kept-alive connection (e.g. it restarted), try once more on a new one
+            self.connection = None
+            status, reply = self._post(body, data.shape[1])
+        if status != 200:
+            raise RuntimeError(f"prediction server answered {status}: {json.loads(reply).get('error')}")
+        return np.frombuffer(reply, dtype='<f8')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve precip type predictions from one loaded model")
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--model', default=MODEL_FILE, help="model file, reloaded when it changes")
+    parser.add_argument('--max-batch-rows', type=int, default=MAX_BATCH_ROWS, help="most rows predicted at once")
+    parser.add_argument('--batch-wait', type=float, default=BATCH_WAIT, help="seconds to wait for more requests to batch")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    batcher = MicroBatcher(args.model, args.max_batch_rows, args.batch_wait)
+    server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    print(f"serving {args.model} on http://{args.host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+    return 0
+
+if __name__=="__main__":
+    main()
@@ -1,6 +1,10 @@
 #file to combine relevant data into one file from synoptic obs and soundings obs
 import pandas as pd
+import numpy as np
 import os 
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from table_io import write_table
 
 #DATE tells date/time (1950-01-01T00:00:00), 
 #columns AT1 through AT8 are the relevant ones. Can be none or 8 entries here. Could be snow and rain and freezing rain in last hour.
@@ -40,18 +44,36 @@ def process_temp(temp):
     #convert to float
     return temperature
 
+#vectorized process_temp for a whole column of "value,qc" strings
+def process_temps(temps):
+    return pd.to_numeric(temps.str.replace(r",.*", "", regex=True)).astype(float)/10
+
+#present weather codes for manual (MW) and automatic (AW) obs, sorted into rain, mixed and frozen
+MW_RAIN = ["20","21","23","25","80","81","82"] + [str(i) for i in range(50,68,1)]
+MW_MIXED = ["23","26","68","69","83","84"]
+MW_FROZEN = ["22","85","86"] + [str(i) for i in range(70,80,1)] 
+
+#list of corresponding values for aw readings
+AW_RAIN = ["23","25","43","44","81","82","83","84"] + [str(i) for i in range(50,67,1)]
+AW_MIXED = ["67","68"]
+AW_FROZEN = ["24","45","46","85","86","87"] + [str(i) for i in range(70,79,1)] 
+
+QC_BAD_CODES = ["3","7"]
+
+AW_COLUMNS = ["AW1", "AW2", "AW3", "AW4"]
+MW_COLUMNS = ["MW1", "MW2", "MW3", "MW4", "MW5", "MW6"]
+
 #function which extracts the precipitation type from a given synoptic obs row
 def precip_type(row):
-    mw_rain = ["20","21","23","25","80","81","82"] + [str(i) for i in range(50,68,1)]
-    mw_mixed = ["23","26","68","69","83","84"]
-    mw_frozen = ["22","85","86"] + [str(i) for i in range(70,80,1)] 
+    mw_rain = MW_RAIN
+    mw_mixed = MW_MIXED
+    mw_frozen = MW_FROZEN
 
-    #list of corresponding values for aw readings
-    aw_rain = ["23","25","43","44","81","82","83","84"] + [str(i) for i in range(50,67,1)]
-    aw_mixed = ["67","68"]
-    aw_frozen = ["24","45","46","85","86","87"] + [str(i) for i in range(70,79,1)] 
+    aw_rain = AW_RAIN
+    aw_mixed = AW_MIXED
+    aw_frozen = AW_FROZEN
 
-    qc_bad_codes = ["3","7"]
+    qc_bad_codes = QC_BAD_CODES
 
     all_obs = [] #AWs and MWs
 
@@ -114,46 +136,126 @@ def precip_type(row):
         else:
             return "1"
 
-def read_synoptic(filepath):
-    syn_data = pd.read_csv(filepath, sep=',', header=0, dtype=str)
+#lookup array from a two digit weather code to 0 (rain), 1 (mixed), 2 (frozen) or -1 (anything else)
+#lists are applied in reverse order of precedence, so a code in both the rain and mixed lists is rain, like in precip_type
+def _code_lookup(rain, mixed, frozen):
+    lookup = np.full(100, -1, dtype=np.int8)
+    lookup[[int(code) for code in frozen]] = 2
+    lookup[[int(code) for code in mixed]] = 1
+    lookup[[int(code) for code in rain]] = 0
+    return lookup
+
+MW_LOOKUP = _code_lookup(MW_RAIN, MW_MIXED, MW_FROZEN)
+AW_LOOKUP = _code_lookup(AW_RAIN, AW_MIXED, AW_FROZEN)
+
+#splits a weather column ("code,qc") into weather codes and quality codes
+#a column only holds a few hundred distinct strings, so each distinct string is split once. Returns the position of
+#every row's value in the distinct arrays, plus the code and quality code of each distinct value
+def split_weather_column(column):
+    positions, distinct = pd.factorize(column, use_na_sentinel=False)
+    parts = [str(value).split(",") for value in distinct]
+    code = np.array([p[0] for p in parts], dtype=object)
+    qc = np.array([p[1] if len(p) > 1 else "" for p in parts], dtype=object)
+    return positions, code, qc
+
+#vectorized version of precip_type over a whole frame with stripped AW1-4 and MW1-6 string columns ("" when missing)
+#each report is mapped to -1/0/1/2 through the lookup arrays, then the same rules as precip_type are applied:
+#one precip type reported -> that type, none (or only bad reports) -> -1, more than one -> 1 (mixed)
+#returns the precip types as strings, like precip_type
+def classify_precip(df):
+    #which of bad (-1), rain (0), mixed (1) and frozen (2) show up in each row
+    seen = np.zeros((len(df), 4), dtype=bool)
+    rows = np.arange(len(df))
+    for columns, lookup in ((AW_COLUMNS, AW_LOOKUP), (MW_COLUMNS, MW_LOOKUP)):
+        for column in columns:
+            positions, code, qc = split_weather_column(df[column])
+            two_digit = np.array([len(c) == 2 and c.isdigit() and c.isascii() for c in code], dtype=bool)
+            number = np.array([int(c) if ok else 0 for c, ok in zip(code, two_digit)], dtype=np.int64)
+            kind = np.where(two_digit, lookup[number], -1)
+            kind = np.where(np.isin(qc, QC_BAD_CODES), -1, kind)
+            #blank reports are skipped
+            kind = np.where(code == "", -2, kind)
 
-    #clean up the data and make it all strings
+            row_kind = kind[positions]
+            reported = row_kind > -2
+            seen[rows[reported], row_kind[reported] + 1] = True
 
-    #select only columns of interest and drop those without relevant info
-    #also want: MW1-7 (manual reporting), AW1-4 (automatic current cond reporting)
-    useful_data = syn_data[["DATE", "TMP", "DEW", "REPORT_TYPE", "AW1", "AW2", "AW3", "AW4", "MW1", "MW2", "MW3", "MW4", "MW5", "MW6"]]
+    n_types = seen[:, 1:].sum(axis=1)
+    single = np.argmax(seen[:, 1:], axis=1)
+    result = np.where(n_types == 0, -1, np.where(n_types == 1, single, 1))
+    return pd.Series(np.array(["-1", "0", "1", "2"], dtype=object)[result + 1], index=df.index)
+
+#only these columns are read from the global-hourly files, everything else is skipped by the CSV parser
+#also want: MW1-7 (manual reporting), AW1-4 (automatic current cond reporting)
+SYNOPTIC_COLUMNS = ["STATION", "DATE", "TMP", "DEW", "REPORT_TYPE"] + AW_COLUMNS + MW_COLUMNS
+
+#cleans and classifies one chunk of raw synoptic rows
+def clean_synoptic(chunk):
+    #older files don't have every AW/MW column, those are treated as empty
+    useful_data = chunk.reindex(columns=SYNOPTIC_COLUMNS)
     cleaned_df = useful_data.dropna(subset=['DATE', 'TMP', "DEW"])
-    cleaned_df = cleaned_df[cleaned_df["REPORT_TYPE"] != "SOD"]
+    #report types are padded with spaces ("SOD  "), so strip before comparing
+    cleaned_df = cleaned_df[cleaned_df["REPORT_TYPE"].str.strip() != "SOD"]
     cleaned_df = cleaned_df.dropna(subset=["AW1", "MW1"], how="all")
     
     cleaned_df = cleaned_df.fillna("")
     #ensure zero whitespace on front or end
-    cleaned_df = cleaned_df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    for column in cleaned_df.columns:
+        cleaned_df[column] = cleaned_df[column].astype(str).str.strip()
 
-    cleaned_df["TMP_FLT"] = cleaned_df["TMP"].apply(process_temp)
-    cleaned_df["DEW_FLT"] = cleaned_df["DEW"].apply(process_temp)
-    cleaned_df["PRECIP_TYPE"] = cleaned_df.apply(precip_type, axis=1)
+    cleaned_df["TMP_FLT"] = process_temps(cleaned_df["TMP"])
+    cleaned_df["DEW_FLT"] = process_temps(cleaned_df["DEW"])
+    cleaned_df["PRECIP_TYPE"] = classify_precip(cleaned_df)
 
     #drop those with erroneous precip values
     cleaned_df = cleaned_df[cleaned_df["PRECIP_TYPE"] != "-1"]
     
     return cleaned_df
 
+#the (empty) frame read_synoptic returns for a file with no usable rows
+def read_synoptic_empty():
+    return clean_synoptic(pd.DataFrame(columns=SYNOPTIC_COLUMNS, dtype=str))
+
+#reads a global-hourly CSV chunksize rows at a time, so only the rows that survive cleaning are kept in memory
+def read_synoptic(filepath, chunksize=250000):
+    reader = pd.read_csv(filepath, sep=',', header=0, dtype=str, usecols=lambda column: column in SYNOPTIC_COLUMNS, chunksize=chunksize)
+    cleaned = [clean_synoptic(chunk) for chunk in reader]
+    if not cleaned:
+        return read_synoptic_empty()
+    return pd.concat(cleaned)
+
+#reads many global-hourly files (NCEI serves one per station and year) in parallel, one file per worker process
+#processes defaults to the number of cores. Rows are returned in the order of the files given
+def read_synoptic_files(filepaths, processes=None, chunksize=250000):
+    filepaths = list(filepaths)
+    if not filepaths:
+        return read_synoptic_empty()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        frames = list(pool.map(read_synoptic, filepaths, [chunksize] * len(filepaths)))
+    return pd.concat(frames, ignore_index=True)
+
 def main():
     #path to data
     datapath = ".\data"
     synoptic = "gb_synoptic.csv"
     syn_file = os.path.join(datapath, synoptic)
+
+    #set this to a directory of global-hourly CSVs (e.g. one per station-year) to read all of them in parallel
+    #the station id is then kept as a column in the output
+    synoptic_dir = None
     
     #run processing functions
-    syn_df: pd.DataFrame = read_synoptic(syn_file)
-
-    simple_df = syn_df[["DATE","TMP_FLT","DEW_FLT", "PRECIP_TYPE"]]
+    if synoptic_dir is not None:
+        syn_df: pd.DataFrame = read_synoptic_files(sorted(glob.glob(os.path.join(synoptic_dir, "*.csv"))))
+        simple_df = syn_df[["STATION","DATE","TMP_FLT","DEW_FLT", "PRECIP_TYPE"]]
+    else:
+        syn_df: pd.DataFrame = read_synoptic(syn_file)
+        simple_df = syn_df[["DATE","TMP_FLT","DEW_FLT", "PRECIP_TYPE"]]
 
     simple_df.rename(columns={"DATE":"DATE", "TMP_FLT":"TMP[C]","DEW_FLT":"DEWPOINT[C]","PRECIP_TYPE":"PRECIP_TYPE"}, inplace=True)
 
-    #write output to a CSV file
-    simple_df.to_csv("filtered_gb_synoptic_obs.csv")
+    #write output to a typed parquet file for combine_snd_sfc.py, a .csv name writes plain text instead
+    write_table(simple_df, "filtered_gb_synoptic_obs.parquet")
 
     print(syn_df.info)
 
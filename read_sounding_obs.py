@@ -1,11 +1,20 @@
 import pandas as pd 
+import numpy as np
 import os
 import math
+import gzip
+import zipfile
+import glob
+import json
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from table_io import write_table
 
 #for soundings
 #first sounding is from 1940, so precedes synoptic obs 
 #pressure (3rd column), height (4th column), temperature (5th column), dew point depression (7th column), wind direction (8th), wind speed (9th)
-# a string of #USM00072645 signals the beginning of a new sounding, followed by year, month, day, 99, hhmm
+# a line starting with # and the station id (#USM00072645 for Green Bay) signals the beginning of a new sounding, followed by year, month, day, hour, hhmm
 
 #given two heights, pressures, and temperatures, calculate temperature at a chosen pressure level between
 def interp_level(h1, h2, p1, p2, t1, t2, plevel): #the final param here is the intermediate level you are trying to find (in hPa)
@@ -28,53 +37,417 @@ def interp_level(h1, h2, p1, p2, t1, t2, plevel): #the final param here is the i
 
     del_h1 = ((Tv*Rd) / g)*math.log(p1/plevel) / (h2-h1) #distance to h1 (lower level)
     del_h2 = ((Tv*Rd) / g)*math.log(plevel/p2) / (h2-h1) #distance to h2 (upper level)
-    print(del_h1)
-    print(t1)
-    print(del_h2)
-    print(t2)
-    print(Tv-273.15)
 
     #T_level = (t1*del_h1 + t2*del_h2 + Tv)/2 #we're doing a funky sort of averaging here that is weighted based on distance
     T_level = (t1*(math.log(-0.6322*del_h2+1)+1) + t2*(math.log(-0.6322*del_h2+1)+1) + Tv*min(del_h1, del_h2))/(1.5-min(del_h1,del_h2)) #VERY rough estimation, can definitely use fine tuning. Attempt at capturing missed inversions
     #WORK IN PROGRESS, not viable formula, will take lots of work
     return T_level - 273.15
 
-#returns a list of lists of lists, where each list is a sounding and the sub lists are levels within the sounding. Values are not removed or processed.
-#they are simply read. Processing is left for another function
-def read_sounding(filepath):
-    all_soundings = []
-    with open(filepath, "r") as file:
-        lines = file.readlines()
-        sounding = []
-        for line in lines:
-            items = line.split()
-            if "#USM00072645" in items: #this line here needs to be improved
-                #this is the start of a new sounding
-                #append sounding and then clear
-                if len(sounding) != 0:
-                    all_soundings.append(sounding)
-                sounding = []
-                sounding.append([items[1],items[2],items[3],items[4]]) #year, month, day, hour 
-            else:
-                #this is data row and we need to process it
-                #I hate doing this, but because of how messy it is, we kind of have to
-                row_num = line[:2] 
-                seconds = line[2:8]
-                pressure = line[8:16]
-                height = line[16:22]
-                temp = line[22:28]
-                rh = line[28:33]
-                dew = line[33:39]
-                wd = line[39:45]
-                ws = line[45:51]
-                all_together = [row_num, seconds, pressure, height, temp, rh, dew, wd, ws]
-                sounding.append(all_together)
+#array version of interp_level. Every argument can be a NumPy array (or scalar) and they are broadcast together,
+#so a whole column of level pairs is interpolated in one pass. The Celsius/Kelvin check is done per element on t1
+def interp_level_array(h1, h2, p1, p2, t1, t2, plevel):
+    h1, h2, p1, p2, t1, t2, plevel = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64) for a in (h1, h2, p1, p2, t1, t2, plevel)))
+
+    celsius = t1 < 100
+    t1 = np.where(celsius, t1 + 273.15, t1)
+    t2 = np.where(celsius, t2 + 273.15, t2)
+
+    g = 9.8 #m/s
+    Rd = 287 #J/kg K
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Tv = (((h2 - h1)*g)/Rd)/np.log(p1/p2)
+
+        del_h1 = ((Tv*Rd) / g)*np.log(p1/plevel) / (h2-h1) #distance to h1 (lower level)
+        del_h2 = ((Tv*Rd) / g)*np.log(plevel/p2) / (h2-h1) #distance to h2 (upper level)
+
+        nearest = np.minimum(del_h1, del_h2)
+        T_level = (t1*(np.log(-0.6322*del_h2+1)+1) + t2*(np.log(-0.6322*del_h2+1)+1) + Tv*nearest)/(1.5-nearest)
+    return T_level - 273.15
+
+#IGRA v2 data records are fixed width (51 characters). These are the [start, end) character spans of each field
+#the numeric fields that carry a QC letter ('A' or 'B') have that letter in the last character of the span
 #col seconds pres hght    temp  rh    dew    wd    ws
 #10  8030   5000 20973B -552B  208   116    36    51
 #31 -9999  -9999   218 -9999 -9999 -9999   315    60 
 # pressure, temperature, geopotential height, relative humidity, dew point depression, wind direction and speed, and elapsed time since launch.
-
-    return all_soundings 
+IGRA_LINE_WIDTH = 51
+IGRA_FIELDS = {
+    "lvltyp": (0, 2),
+    "etime": (2, 8),
+    "pressure": (8, 15),
+    "height": (16, 21),
+    "temp": (22, 27),
+    "rh": (28, 33),
+    "dpdp": (33, 39),
+    "wdir": (39, 45),
+    "wspd": (45, 51),
+}
+#position of the QC letter that follows pressure, height and temperature
+IGRA_FLAGS = {"pflag": 15, "zflag": 21, "tflag": 27}
+#scale factor taking the raw integers into hPa, m, C, %, C, degrees and m/s
+IGRA_SCALE = {"pressure": 100, "height": 1, "temp": 10, "rh": 10, "dpdp": 10, "wdir": 1, "wspd": 10}
+#-9999 is missing, -8888 is removed by QC. Both become NaN in the parsed table
+IGRA_MISSING = (-9999, -8888)
+
+#QC letters become small ints: blank = 0, A = 1, B = 2
+_FLAG_CODES = np.zeros(256, dtype=np.int8)
+_FLAG_CODES[ord("A")] = 1
+_FLAG_CODES[ord("B")] = 2
+
+#number of data lines decoded at once, keeps the temporary index arrays to a few tens of MB
+_DECODE_CHUNK = 65536
+
+#turns a block of ascii bytes (one row per line) into integers. Spaces and QC letters are ignored, a '-' makes the value negative
+def _fixed_width_ints(block):
+    value = np.zeros(len(block), dtype=np.int64)
+    for j in range(block.shape[1]):
+        col = block[:, j].astype(np.int64)
+        is_digit = (col >= 48) & (col <= 57)
+        value = np.where(is_digit, value * 10 + (col - 48), value)
+    negative = (block == ord("-")).any(axis=1)
+    return np.where(negative, -value, value)
+
+#decodes every data line (given by start offset and length into buf) into typed columns
+def _decode_levels(buf, starts, lengths):
+    columns = {name: [] for name in list(IGRA_FIELDS) + list(IGRA_FLAGS)}
+    offsets = np.arange(IGRA_LINE_WIDTH)
+    for c in range(0, len(starts), _DECODE_CHUNK):
+        s = starts[c:c + _DECODE_CHUNK]
+        n = lengths[c:c + _DECODE_CHUNK]
+        #short lines are padded with spaces so every row is IGRA_LINE_WIDTH wide
+        idx = np.minimum(s[:, None] + offsets, len(buf) - 1)
+        block = np.where(offsets < n[:, None], buf[idx], ord(" ")).astype(np.uint8)
+
+        for name, (a, b) in IGRA_FIELDS.items():
+            columns[name].append(_fixed_width_ints(block[:, a:b]))
+        for name, pos in IGRA_FLAGS.items():
+            columns[name].append(_FLAG_CODES[block[:, pos]])
+
+    levels = {}
+    for name, parts in columns.items():
+        values = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+        if name == "lvltyp" or name in IGRA_FLAGS:
+            levels[name] = values.astype(np.int8)
+        else:
+            values = values.astype(np.float64)
+            values[np.isin(values, IGRA_MISSING)] = np.nan
+            levels[name] = values / IGRA_SCALE.get(name, 1)
+    return pd.DataFrame(levels)
+
+#header lines look like: #USM00072645 1940 05 01 99 0300 ...
+#station id, year, month, day, hour (99 means the hour is missing)
+def _decode_headers(buf, starts, lengths):
+    station, year, month, day, hour = [], [], [], [], []
+    for s, n in zip(starts, lengths):
+        items = bytes(buf[s:s + n]).decode("ascii", "replace").split()
+        station.append(items[0][1:])
+        year.append(int(items[1]))
+        month.append(int(items[2]))
+        day.append(int(items[3]))
+        hour.append(int(items[4]))
+    index = pd.DataFrame({
+        "station": station,
+        "year": np.array(year, dtype=np.int16),
+        "month": np.array(month, dtype=np.int8),
+        "day": np.array(day, dtype=np.int8),
+        "hour": np.array(hour, dtype=np.int8),
+    })
+    valid_hour = index["hour"].to_numpy() <= 23
+    date = pd.to_datetime(index[["year", "month", "day"]].assign(hour=np.where(valid_hour, index["hour"], 0)), errors="coerce")
+    index["date"] = date.where(valid_hour)
+    return index
+
+#in-memory sounding record set passed between the processing functions
+#levels is the columnar table of every level (see _decode_levels), index has one row per sounding
+#(station, date parts, date) and its offset/count columns give the rows of levels belonging to each sounding
+class Soundings:
+    __slots__ = ("levels", "index")
+
+    def __init__(self, levels, index):
+        self.levels = levels
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    #position of the owning sounding for every level
+    def sounding_id(self):
+        return np.repeat(np.arange(len(self.index)), self.index["count"].to_numpy())
+
+    #date/time string of each sounding as written in the output files (YYYY-MM-DDTHH:00:00)
+    def dates(self):
+        index = self.index
+        return (index["year"].astype(str).str.zfill(4) + "-" + index["month"].astype(str).str.zfill(2)
+                + "-" + index["day"].astype(str).str.zfill(2) + "T" + index["hour"].astype(str).str.zfill(2) + ":00:00")
+
+    #subset of soundings (boolean mask or positions) along with their levels, offsets are rebuilt
+    def take(self, which):
+        which = np.asarray(which)
+        if which.dtype != bool:
+            mask = np.zeros(len(self.index), dtype=bool)
+            mask[which] = True
+            which = mask
+        level_mask = np.repeat(which, self.index["count"].to_numpy())
+        index = self.index[which].reset_index(drop=True)
+        index["offset"] = np.cumsum(index["count"].to_numpy()) - index["count"].to_numpy()
+        return Soundings(self.levels[level_mask].reset_index(drop=True), index)
+
+    #soundings start:stop. The level rows are a contiguous slice so nothing is copied
+    def slice(self, start, stop):
+        index = self.index.iloc[start:stop].reset_index(drop=True)
+        first = int(index["offset"].iloc[0]) if len(index) else 0
+        last = first + int(index["count"].sum())
+        index["offset"] = index["offset"] - first
+        return Soundings(self.levels.iloc[first:last].reset_index(drop=True), index)
+
+    #keeps only the levels selected by a boolean mask over levels, every sounding is kept
+    def take_levels(self, mask):
+        counts = np.bincount(self.sounding_id()[mask], minlength=len(self.index))
+        index = self.index.assign(count=counts, offset=np.cumsum(counts) - counts)
+        return Soundings(self.levels[mask].reset_index(drop=True), index)
+
+#bulk parser for a block of IGRA text (bytes). Returns the Soundings held in it
+def parse_igra(data):
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if len(buf) == 0:
+        return Soundings(_decode_levels(buf, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)), _decode_headers(buf, [], []))
+
+    ends = np.flatnonzero(buf == ord("\n"))
+    if buf[-1] != ord("\n"):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    #windows line endings
+    lengths = lengths - ((lengths > 0) & (buf[np.maximum(ends - 1, 0)] == ord("\r")))
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+
+    is_header = buf[starts] == ord("#")
+    #data lines that appear before the first header don't belong to any sounding
+    in_sounding = np.cumsum(is_header) > 0
+    data_lines = ~is_header & in_sounding
+
+    levels = _decode_levels(buf, starts[data_lines], lengths[data_lines])
+    index = _decode_headers(buf, starts[is_header], lengths[is_header])
+
+    #every data line belongs to the last header above it
+    sounding_of_line = np.cumsum(is_header)[data_lines] - 1
+    index["count"] = np.bincount(sounding_of_line, minlength=len(index)).astype(np.int64)
+    index["offset"] = np.cumsum(index["count"].to_numpy()) - index["count"].to_numpy()
+    return Soundings(levels, index)
+
+#opens an IGRA station file for binary reading. Plain text, gzip (.gz) and zip (.zip) archives are read directly
+#a zip archive is expected to hold the station's data file, the first member is used
+def open_sounding_file(filepath):
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "rb")
+    if filepath.endswith(".zip"):
+        archive = zipfile.ZipFile(filepath)
+        members = [name for name in archive.namelist() if not name.endswith("/")]
+        if not members:
+            archive.close()
+            raise ValueError("no data file in " + filepath)
+        #the archive has to stay open as long as the member is being read
+        member = archive.open(members[0])
+        member_close = member.close
+        def close():
+            member_close()
+            archive.close()
+        member.close = close
+        return member
+    return open(filepath, "rb")
+
+#reads an IGRA station file into Soundings (see parse_igra)
+#values are only decoded and scaled, no levels are removed. Processing is left for another function
+#with a cache_dir the parsed tables are stored on disk and later calls load them from there instead of parsing
+def read_sounding(filepath, cache_dir=None):
+    if cache_dir is not None:
+        entry = find_cached_soundings(filepath, cache_dir)
+        if entry is not None:
+            return load_cached_soundings(entry)
+
+    with open_sounding_file(filepath) as file:
+        data = file.read()
+    soundings = parse_igra(data)
+
+    if cache_dir is not None:
+        writer = SoundingCacheWriter(filepath, cache_dir)
+        writer.append(soundings)
+        writer.commit()
+    return soundings
+
+#streaming version of read_sounding. Yields Soundings for batches of complete soundings,
+#reading roughly chunk_bytes of the file at a time, so memory use does not depend on the size of the file
+#with a cache_dir, batches come straight from the memory mapped cache when the file has been parsed before
+def iter_soundings(filepath, chunk_bytes=8*1024*1024, cache_dir=None):
+    if cache_dir is not None:
+        entry = find_cached_soundings(filepath, cache_dir)
+        if entry is not None:
+            soundings = load_cached_soundings(entry)
+            #batches of roughly the same number of levels as a chunk_bytes sized piece of text would hold
+            per_batch = max(1, chunk_bytes // (IGRA_LINE_WIDTH + 1))
+            counts = soundings.index["count"].to_numpy()
+            ends = np.cumsum(counts)
+            start = 0
+            while start < len(soundings):
+                stop = max(start + 1, int(np.searchsorted(ends, ends[start] - counts[start] + per_batch, side="right")))
+                yield soundings.slice(start, stop)
+                start = stop
+            return
+
+    writer = SoundingCacheWriter(filepath, cache_dir) if cache_dir is not None else None
+    try:
+        for soundings in _iter_parsed(filepath, chunk_bytes):
+            if writer is not None:
+                writer.append(soundings)
+            yield soundings
+        if writer is not None:
+            writer.commit()
+            writer = None
+    finally:
+        #the consumer stopped early or parsing failed, don't leave a partial cache entry behind
+        if writer is not None:
+            writer.discard()
+
+def _iter_parsed(filepath, chunk_bytes):
+    with open_sounding_file(filepath) as file:
+        pending = b""
+        while True:
+            chunk = file.read(chunk_bytes)
+            if not chunk:
+                break
+            pending += chunk
+            #everything before the last header is made of complete soundings
+            cut = pending.rfind(b"\n#")
+            if cut == -1:
+                continue
+            complete, pending = pending[:cut + 1], pending[cut + 1:]
+            soundings = parse_igra(complete)
+            if len(soundings):
+                yield soundings
+        if pending:
+            soundings = parse_igra(pending)
+            if len(soundings):
+                yield soundings
+
+#sounding cache
+#parsed tables are kept in cache_dir/<key>/ as one raw binary column per file plus a meta.json describing them,
+#so they can be memory mapped back without copying. The key is built from the source file's absolute path, size,
+#modification time and SOUNDING_PARSER_VERSION, so editing the file or changing the parser invalidates the entry.
+#When an entry is written, older entries for the same source file are removed and the least recently used entries
+#are evicted until the cache is under SOUNDING_CACHE_MAX_BYTES
+SOUNDING_PARSER_VERSION = 1 #bump this whenever parse_igra changes the values it produces
+SOUNDING_CACHE_MAX_BYTES = 4 * 1024**3
+IGRA_ID_WIDTH = 11
+
+def sounding_cache_key(filepath):
+    path = os.path.abspath(filepath)
+    stat = os.stat(path)
+    fingerprint = path + "|" + str(stat.st_size) + "|" + str(stat.st_mtime_ns) + "|" + str(SOUNDING_PARSER_VERSION)
+    return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:20]
+
+#returns the cache entry directory for a file, or None if it hasn't been cached (or the cached copy is stale)
+def find_cached_soundings(filepath, cache_dir):
+    entry = os.path.join(cache_dir, sounding_cache_key(filepath))
+    meta = os.path.join(entry, "meta.json")
+    if not os.path.exists(meta):
+        return None
+    #mark as recently used for eviction
+    os.utime(meta)
+    return entry
+
+#memory maps a cache entry back into Soundings
+def load_cached_soundings(entry):
+    with open(os.path.join(entry, "meta.json")) as file:
+        meta = json.load(file)
+    tables = []
+    for table in ("levels", "soundings"):
+        columns = {}
+        n = meta["rows"][table]
+        for name, dtype in meta["columns"].get(table, []):
+            path = os.path.join(entry, table + "." + name + ".bin")
+            if n == 0:
+                columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                columns[name] = np.asarray(np.memmap(path, dtype=dtype, mode="r", shape=(n,)))
+        if table == "soundings":
+            columns["station"] = columns["station"].astype(str).astype(object)
+        tables.append(pd.DataFrame(columns, copy=False))
+    return Soundings(tables[0], tables[1])
+
+#writes parsed batches into a new cache entry. Nothing is visible to readers until commit()
+class SoundingCacheWriter:
+    def __init__(self, filepath, cache_dir, max_bytes=None):
+        self.source = os.path.abspath(filepath)
+        self.cache_dir = cache_dir
+        self.max_bytes = SOUNDING_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.key = sounding_cache_key(filepath)
+        self.tmp = os.path.join(cache_dir, self.key + ".tmp-" + str(os.getpid()))
+        os.makedirs(self.tmp, exist_ok=True)
+        self.rows = {"levels": 0, "soundings": 0}
+        self.columns = {}
+
+    def _write(self, table, frame):
+        dtypes = []
+        for name in frame.columns:
+            values = frame[name].to_numpy()
+            if name == "station":
+                values = values.astype("S" + str(IGRA_ID_WIDTH))
+            dtypes.append([name, values.dtype.str])
+            with open(os.path.join(self.tmp, table + "." + name + ".bin"), "ab") as file:
+                file.write(np.ascontiguousarray(values).tobytes())
+        self.columns[table] = dtypes
+        self.rows[table] += len(frame)
+
+    def append(self, soundings):
+        #offsets are relative to the batch, shift them to the position of the batch in the whole table
+        index = soundings.index.assign(offset=soundings.index["offset"] + self.rows["levels"])
+        self._write("levels", soundings.levels)
+        self._write("soundings", index)
+
+    def commit(self):
+        stat = os.stat(self.source)
+        meta = {"source": self.source, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                "parser_version": SOUNDING_PARSER_VERSION, "rows": self.rows, "columns": self.columns}
+        with open(os.path.join(self.tmp, "meta.json"), "w") as file:
+            json.dump(meta, file)
+        entry = os.path.join(self.cache_dir, self.key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.replace(self.tmp, entry)
+        evict_sounding_cache(self.cache_dir, self.max_bytes, keep=self.key, source=self.source)
+        return entry
+
+    def discard(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+#cache eviction policy: entries for `source` other than `keep` are stale (the file changed) and always removed,
+#then the least recently used entries are removed until the cache holds at most max_bytes
+def evict_sounding_cache(cache_dir, max_bytes=SOUNDING_CACHE_MAX_BYTES, keep=None, source=None):
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        meta = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta):
+            continue
+        if key != keep and source is not None:
+            with open(meta) as file:
+                if json.load(file)["source"] == source:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    continue
+        size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+        entries.append((os.path.getmtime(meta), key, size))
+
+    total = sum(size for _, _, size in entries)
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+    return total
 
 # ln ew(T) = -6096.9385 T-1 + 21.2409642 - 2.711193×10-2 T + 1.673952×10-5 T2 + 2.433502 ln T  
 #equation for calculating saturation vapor pressure when temp is less than 0 C:
@@ -99,68 +472,33 @@ def dewpoint_cal(temp, rh):
     constA = 2.53*10**11 #Pa
     constB = 5.42*10**3 #K
     return (-1*constB)/(math.log(e_real/constA)) - 273.15
+
+#array version of dewpoint_cal. temp and rh can be NumPy arrays (or scalars) and are broadcast together
+#the over water / over ice constants are picked per element with a mask. Missing (NaN) inputs give NaN,
+#and an RH of 0 gives -273.15 instead of raising like the scalar version
+def dewpoint_cal_array(temp, rh):
+    t = np.asarray(temp, dtype=np.float64)
+    rh = np.asarray(rh, dtype=np.float64)
+
+    above_freezing = t > 0
+    a = np.where(above_freezing, 17.62, 22.46)
+    b = np.where(above_freezing, 243.12, 272.62)
+
+    constA = 2.53*10**11 #Pa
+    constB = 5.42*10**3 #K
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Es = np.power(math.e, math.log(611.2) + (a*t)/(b+t))
+        e_real = (rh/100)*Es
+        return (-1*constB)/(np.log(e_real/constA)) - 273.15
     
 
 
-#filters out those soundings that don't have pressure values
-#extracts all readings from 850 and below
-#these obs are written into the following structure, where each row is a time and each column is a pressure level
-# "pressure level, temperature, dewpoint, wind speed, wind direction"
-def filter(soundings_list):
-    to_write = [] #list of lists to write to the CSV file
-    for sounding in soundings_list:
-        relevant_info = ""
-        datetime = sounding[0]
-        datetime = datetime[0]+"-"+datetime[1]+"-"+datetime[2]+"T"+datetime[3]+":00:00"
-        relevant_info = relevant_info + datetime
-        for i in range(len(sounding)):
-            if i == 0:
-                i+=1
-                #do nothing else
-            else:
-                level = sounding[i]
-                try: 
-                    pressure = level[2]
-                    try:
-                        pressure = int(pressure)/100
-                    except:
-                        pressure = int(pressure[:-1])/100
-                    
-                    height = level[3]
-                    try:
-                        height = int(height)
-                    except:
-                        height = int(height[:-1])
-                    
-                    tmp = level[4]
-                    try:
-                        tmp = int(tmp)/10
-                    except:
-                        tmp = int(tmp[:-1])/10
-
-                    rh = level[5]
-                    try:
-                        rh = int(rh)/10
-                    except:
-                        rh = int(rh[:-1])/10
-
-                    dew = level[6]
-                    try:
-                        dew = int(dew)/10
-                    except:
-                        dew = int(dew[:-1])/10
-                    
-                    
-                    if pressure == -99.99 or pressure <= 600: #filter out obs above 600 mb
-                        i+=1
-                    else:
-                        column = ","+str(pressure) +" "+ str(height)+" " + str(tmp)+" " + str(dew) + " " + str(rh)
-                        relevant_info = relevant_info + column
-                        i+=1
-                except IndexError:
-                    continue
-        to_write.append(relevant_info)
-    return to_write
+#filters out those levels that don't have pressure values
+#extracts all readings from min_pressure (600 mb by default) and below
+#every sounding is kept, soundings with no levels left are skipped later by basic_final
+def filter(soundings, min_pressure=600):
+    keep = (soundings.levels["pressure"] > min_pressure).to_numpy() #comparisons with missing (NaN) pressures are False
+    return soundings.take_levels(keep)
 
 #equation for calculating saturation vapor pressure when temperature is over 0 C:
 # ln ew(T) = -6096.9385 T-1 + 21.2409642 - 2.711193×10-2 T + 1.673952×10-5 T2 + 2.433502 ln T  
@@ -172,120 +510,148 @@ def filter(soundings_list):
 # A = 2.53x10^11 Pa, B = 5.37 x 10^7 K 
 #note that the original equations give their answers in Pa also
 
+#temperature and dewpoint of every level, plus whether the level is usable (has a temperature and either a
+#dewpoint depression or an RH, in which case the dewpoint is calculated from RH)
+def _level_dewpoints(levels):
+    tmp = levels["temp"].to_numpy()
+    dpdp = levels["dpdp"].to_numpy()
+    rh = levels["rh"].to_numpy()
+
+    has_dew = dpdp > -200
+    valid = (tmp > -200) & (has_dew | (rh > -10)) #comparisons with missing (NaN) values are False
+    dew = np.where(has_dew, tmp - dpdp, dewpoint_cal_array(tmp, rh)) #we subtract the depression from the temperature
+    return tmp, dew, valid
+
+#for a set of candidate levels, picks the one with the smallest key in each sounding (ties go to the level listed first)
+#returns the soundings that had a candidate and the chosen level for each
+def _first_per_sounding(sounding_id, candidates, key):
+    order = candidates[np.lexsort((candidates, key[candidates], sounding_id[candidates]))]
+    owner = sounding_id[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = owner[1:] != owner[:-1]
+    return owner[first], order[first]
+
 #final processing phase of the sounding file puts the file into the the following form:
 # datetime 925_temp 925_dew 850_temp 850_dew
-def final_processing(soundings):
-    rows = [] #list of lists of rows
-    for snd in soundings:
-        ta = []
-        
-        #these values hold and find the closest values to each level
-        found850 = False
-        found950 = False
-
-        b850 = [] #pressure, height, t, td, rh  
-        a850 = []
-
-        found925 = False
-        found925 = False
-
-        b925 = []
-        a925 = []
-        
-
-        items = snd.split(",")
-        for i in range(len(items)):
-            if i == 0:
-                ta.append(items[i])
-            else: #this is a pressure level
-                level = items[i].split() #splits based on white space
-                pres = level[0]
-                hght = level[1]
-                tmp = level[2]
-                dew = level[3]
-                rh = level[4]
-                
-        
-        if len(ta) == 1:
-            continue
-        
-
+#WORK IN PROGRESS: for now this finds the closest usable level below (b) and above (a) each target in every sounding,
+#which is what interp_level_array needs to fill in soundings without a level close enough to the target
+def final_processing(soundings, targets=(925, 850)):
+    levels = soundings.levels
+    sounding_id = soundings.sounding_id()
+    pres = levels["pressure"].to_numpy()
+    hght = levels["height"].to_numpy()
+    rh = levels["rh"].to_numpy()
+    tmp, dew, valid = _level_dewpoints(levels)
+
+    rows = pd.DataFrame({"date": soundings.dates()})
+    for target in targets:
+        diff = np.abs(pres - target)
+        for side, mask in (("b", pres >= target), ("a", pres < target)):
+            owner, chosen = _first_per_sounding(sounding_id, np.flatnonzero(valid & mask), diff)
+            for name, values in (("pres", pres), ("hght", hght), ("t", tmp), ("td", dew), ("rh", rh)):
+                column = np.full(len(soundings), np.nan)
+                column[owner] = values[chosen]
+                rows[f"{side}{target:g}_{name}"] = column
+    return rows
 
-        
-    return 0
+#generalized version of basic_final for any set of target pressure levels
+#for each sounding and target, picks the closest level within tolerance (hPa) that has a temperature and either a
+#dewpoint depression or an RH (the dewpoint is then calculated from RH). Ties go to the level listed first, like basic_final
+#returns one row per sounding: date, then t<level>, td<level> for each target. With require_all, soundings missing
+#any of the targets are dropped, otherwise their missing values are NaN
+def select_levels(soundings, targets=(925, 850), tolerance=20, require_all=True):
+    sounding_id = soundings.sounding_id()
+    pres = soundings.levels["pressure"].to_numpy()
+    tmp, dew, valid = _level_dewpoints(soundings.levels)
+
+    features = pd.DataFrame({"date": soundings.dates()})
+    for target in targets:
+        diff = np.abs(pres - target)
+        owner, chosen = _first_per_sounding(sounding_id, np.flatnonzero(valid & (diff < tolerance)), diff)
+
+        t_level = np.full(len(soundings), np.nan)
+        td_level = np.full(len(soundings), np.nan)
+        t_level[owner] = tmp[chosen]
+        td_level[owner] = dew[chosen]
+        features[f"t{target:g}"] = np.round(t_level, 1)
+        features[f"td{target:g}"] = np.round(td_level, 1)
+
+    if require_all:
+        features = features.dropna().reset_index(drop=True)
+    return features
 
-#values are given in: pres, hght, tmp, dew, rh
 #most basic processing function. Does no calculations or gap filling. Only takes those soundings where values aren't missing
+#returns one row per sounding with the columns date, t925, td925, t850, td850
 def basic_final(soundings):
-    rows = []
-    for snd in soundings:
-        items = snd.split(",")
-        l850 = [] #tmp, dew
-        min8diff = 9999
-        l925 = [] #tmp, dew
-        min9diff = 9999
-        date = []
-        for i in range(len(items)):
-            if i == 0:
-                date = items[0]
-            else: #this is a pressure level
-                level = items[i].split() #splits based on white space
-                pres = float(level[0])
-                hght = float(level[1])
-                tmp = float(level[2])
-                dew = float(level[3])
-                rh = float(level[4])
-
-                diff_850 = abs(pres - 850)
-                diff_925 = abs(pres - 925)
-
-                if diff_850 < 20 : #25 mb difference:
-                    if tmp > -200:
-                        if dew > -200:
-                            if not l850 or diff_850 < min8diff:
-                                #then we have a good dew point and this is closer to 850 than previous columns
-                                l850 = [tmp, tmp-dew] #we add temperature to dew because this is given in dewpoint depression
-                                min8diff = diff_850
-                        elif rh > -10: #then we don't have dewpoint, but we can calculate it
-                            if not l850 or diff_850 < min8diff:
-                                l850 = [tmp, dewpoint_cal(tmp, rh)]
-                                min8diff = diff_850
-
-
-                if diff_925 < 20 : #25 mb difference:
-                    if tmp > -200:
-                        if dew > -200:
-                            if not l925 or diff_925 < min9diff:
-                                #then we have a good dew point and this is closer to 850 than previous columns
-                                l925 = [tmp, tmp-dew]
-                                min9diff = diff_925
-                        elif rh > -10: #then we don't have dewpoint, but we can calculate it
-                            if not l925 or diff_925 < min9diff:
-                                l925 = [tmp, dewpoint_cal(tmp, rh)]
-                                min9diff = diff_925
-        if l850 and l925:
-            to_add = date+","+str(round(l925[0],1))+","+str(round(l925[1],1))+","+str(round(l850[0],1))+","+str(round(l850[1],1))
-            rows.append(to_add)
-    return rows
+    return select_levels(soundings, (925, 850))
+
+#soundings whose launch hour isn't known (hour 99) have no usable date, the later stages would only read them as NaT
+def drop_unknown_hours(features):
+    dates = pd.to_datetime(features["date"], format="%Y-%m-%dT%H:%M:%S", errors="coerce")
+    return features[dates.notna().to_numpy()].reset_index(drop=True)
+
+#file extensions picked up when processing a directory of station files
+STATION_FILE_TYPES = (".txt", ".gz", ".zip")
+
+#runs the whole read -> select_levels pipeline on one station file
+#output is partitioned by station: output_dir/station=<id>/<file name>.csv, with the station id as an extra column
+#naming the part after the source file keeps two files holding the same station from overwriting each other
+#returns the number of rows written for each station found in the file
+def process_station_file(snd_file, output_dir):
+    files = {}
+    counts = {}
+    try:
+        for soundings in iter_soundings(snd_file):
+            for station in soundings.index["station"].unique():
+                features = drop_unknown_hours(basic_final(soundings.take((soundings.index["station"] == station).to_numpy())))
+                features["station"] = station
+                if station not in files:
+                    partition = os.path.join(output_dir, "station=" + station)
+                    os.makedirs(partition, exist_ok=True)
+                    part = os.path.basename(snd_file).split(".")[0] + ".csv"
+                    files[station] = open(os.path.join(partition, part), 'w')
+                    files[station].write(",".join(features.columns) + "\n")
+                    counts[station] = 0
+                features.to_csv(files[station], header=False, index=False)
+                counts[station] += len(features)
+    finally:
+        for file in files.values():
+            file.close()
+    return counts
+
+#processes every IGRA station file in a directory in parallel, one file per worker process
+#processes defaults to the number of cores. Returns {station: rows written}
+def process_station_dir(directory, output_dir, processes=None):
+    snd_files = sorted(path for path in glob.glob(os.path.join(directory, "*")) if path.endswith(STATION_FILE_TYPES))
+    totals = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for counts in pool.map(process_station_file, snd_files, [output_dir] * len(snd_files)):
+            for station, n in counts.items():
+                totals[station] = totals.get(station, 0) + n
+    return totals
 
 def main():
 
-    print(interp_level(310, 1370, 966.2, 850, -1, 7.7, 925))
-    quit()
-
     datapath = ".\data"
-    soundings = "USM00072645-data.txt"
+    soundings = "USM00072645-data.txt" #can also be the .zip or .gz archive straight from NCEI
+    #parsed soundings are cached in sounding_cache/, so rerunning after changing basic_final skips parsing
     snd_file = os.path.join(datapath, soundings)
 
-    all_soundings = read_sounding(snd_file)
-    contents = filter(all_soundings)
-    
-    filt_contents = basic_final(contents)
-
-    with open("good_snd_obs.csv", 'w') as file:
-        file.write("date,t925,td925,t850,td850\n")
-        for item in filt_contents:
-            file.write(item + '\n')
+    #set this to a directory of IGRA station files to process all of them in parallel instead of the single file above
+    station_dir = None
+    if station_dir is not None:
+        totals = process_station_dir(station_dir, "good_snd_obs")
+        for station, n in sorted(totals.items()):
+            print(station, n)
+        return 0
+
+    #soundings are processed a batch at a time, so the whole station history is never held in memory
+    #add more pressure levels here to get more features, e.g. (1000, 925, 850, 700, 500)
+    target_levels = (925, 850)
+    #.parquet/.feather hand a typed table to combine_snd_sfc.py, use .csv for a plain text file
+    output = "good_snd_obs.parquet"
+    frames = [drop_unknown_hours(select_levels(soundings, target_levels)) for soundings in iter_soundings(snd_file, cache_dir="sounding_cache")]
+    write_table(pd.concat(frames, ignore_index=True), output)
     return 0
 
 if __name__=="__main__":
@@ -0,0 +1,86 @@
+#reading and writing the tables handed from one stage to the next (good_snd_obs, filtered_gb_synoptic_obs, ultimate_dataset)
+#the format is picked from the file extension:
+# .parquet / .feather: typed columnar files. Dates are stored as datetime64, features as float32 and precip type as a category,
+#   so the next stage reads them back in one go without any per-row formatting or date parsing. Needs pyarrow
+# .csv: the same plain text files as before, for looking at the data or other tools
+#either way, read_table gives back a frame with the same types
+
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNAR_TYPES = (".parquet", ".feather")
+
+#columns that get special types. The sounding and combined files use lowercase names, the surface obs uppercase
+DATE_COLUMNS = ("date", "DATE")
+PRECIP_COLUMNS = ("precip_type", "PRECIP_TYPE")
+PRECIP_TYPE = pd.CategoricalDtype([-1, 0, 1, 2])
+#text columns, like the station id, become categories too
+STRING_COLUMNS = ("station", "STATION")
+
+#how dates are written to CSV files, the same format as the IGRA and global-hourly dates
+CSV_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+#casts a stage table to the types it is stored with. Other float columns (temperatures, dewpoints) become float32
+def typed_frame(df):
+    df = df.copy()
+    for column in df.columns:
+        if column in DATE_COLUMNS:
+            #soundings with an unknown launch hour (99) get NaT
+            if not pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = pd.to_datetime(df[column], format=CSV_DATE_FORMAT, errors="coerce")
+            df[column] = df[column].astype("datetime64[ns]")
+        elif column in PRECIP_COLUMNS:
+            df[column] = df[column].astype(int).astype(PRECIP_TYPE)
+        elif column in STRING_COLUMNS:
+            df[column] = df[column].astype(str).astype("category")
+        elif pd.api.types.is_float_dtype(df[column]):
+            df[column] = df[column].astype(np.float32)
+    return df
+
+def write_table(df, path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in COLUMNAR_TYPES:
+        df = typed_frame(df).reset_index(drop=True)
+        if ext == ".parquet":
+            df.to_parquet(path, index=False)
+        else:
+            df.to_feather(path)
+        return
+    if ext != ".csv":
+        raise ValueError("unknown table format: " + path)
+    #same types as the columnar files, so float32 values are written with as many digits as they have
+    df = typed_frame(df)
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].dt.strftime(CSV_DATE_FORMAT)
+    df.to_csv(path, index=False)
+
+def read_table(path, columns=None):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        df = pd.read_parquet(path, columns=columns)
+    elif ext == ".feather":
+        df = pd.read_feather(path, columns=columns)
+    elif ext == ".csv":
+        df = pd.read_csv(path, usecols=columns)
+        #older surface ob files were written with the row index as an unnamed first column
+        df = df.drop(columns=[c for c in df.columns if c.startswith("Unnamed:")])
+    else:
+        raise ValueError("unknown table format: " + path)
+    #parquet keeps everything but the category of an integer column, so the types are always applied again
+    return typed_frame(df)
+
+#column names of a table, from the file's schema (or header line) without reading any rows
+def table_columns(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        import pyarrow.parquet
+        return list(pyarrow.parquet.read_schema(path).names)
+    if ext == ".feather":
+        import pyarrow.ipc
+        with pyarrow.ipc.open_file(path) as reader:
+            return list(reader.schema.names)
+    if ext == ".csv":
+        return [c for c in pd.read_csv(path, nrows=0).columns if not c.startswith("Unnamed:")]
+    raise ValueError("unknown table format: " + path)
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from combine_snd_sfc import combine_spatial
+from table_io import read_table, write_table
+
+SND_STATIONS = pd.DataFrame({'station': ['USM00072645'], 'lat': [44.5], 'lon': [-88.1]})
+SFC_STATIONS = pd.DataFrame({'station': ['72645014898'], 'lat': [44.48], 'lon': [-88.13]})
+
+def surface_obs():
+    return pd.DataFrame({
+        'STATION': ['72645014898'] * 3,
+        'DATE': pd.to_datetime(['1990-01-01 00:00', '1990-01-01 12:00', '1990-01-02 00:00']),
+        'TMP': [1.0, -2.0, 0.5],
+        'DEW': [-1.0, -4.0, -0.5],
+        'PRECIP_TYPE': [0, 1, 0],
+    })
+
+#a sounding with an unknown launch hour (99) is read back from a stage table with a NaT date
+def test_combine_spatial_skips_missing_hour(tmp_path):
+    path = str(tmp_path / 'soundings.parquet')
+    write_table(pd.DataFrame({
+        'date': ['1990-01-01T00:00:00', '1990-01-01T99:00:00', '1990-01-02T00:00:00'],
+        'station': ['USM00072645'] * 3,
+        't925': [-3.0, -5.0, -4.0],
+    }), path)
+    snd_df = read_table(path)
+    assert snd_df['date'].isna().sum() == 1
+
+    combined = combine_spatial(snd_df, surface_obs(), SND_STATIONS, SFC_STATIONS)
+    assert list(combined['date']) == list(pd.to_datetime(['1990-01-01 00:00', '1990-01-02 00:00']))
+    assert combined['sfc_t'].tolist() == [1.0, 0.5]
+    assert combined['precip_type'].tolist() == [0, 0]
+    np.testing.assert_allclose(combined['t925'], [-3.0, -4.0])
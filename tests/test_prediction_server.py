@@ -0,0 +1,48 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+import prediction_server
+from numpy_gbm import NumpyBooster
+from prediction_server import MicroBatcher, PredictionHandler, RemoteModel
+
+MODEL_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lightgbm_model_v1.txt')
+
+def sample_rows(n):
+    rng = np.random.default_rng(0)
+    return rng.uniform(-20, 10, size=(n, 6))
+
+@pytest.fixture
+def batcher():
+    batcher = MicroBatcher(MODEL_FILE)
+    yield batcher
+    batcher.close()
+
+def test_predict_rejects_wrong_width(batcher):
+    with pytest.raises(ValueError):
+        batcher.predict(np.zeros((3, 4)))
+    with pytest.raises(ValueError):
+        batcher.predict(np.zeros(12))
+
+def test_predict_matches_model(batcher):
+    rows = sample_rows(50)
+    np.testing.assert_array_equal(batcher.predict(rows), NumpyBooster(MODEL_FILE).predict(rows))
+
+#rows that don't fit in one request body are sent in several
+def test_remote_model_splits_big_requests(batcher, monkeypatch):
+    monkeypatch.setattr(prediction_server, 'MAX_REQUEST_BYTES', 8 * 6 * 10)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PredictionHandler)
+    server.batcher = batcher
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    model = RemoteModel(f'http://127.0.0.1:{server.server_port}')
+    try:
+        rows = sample_rows(35)
+        np.testing.assert_array_equal(model.predict(rows), NumpyBooster(MODEL_FILE).predict(rows))
+        assert batcher.stats.snapshot()['requests'] == 4
+        assert len(model.predict(np.zeros((0, 6)))) == 0
+    finally:
+        model.close()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,102 @@
+#parallel hyperparameter search for the model in lightgbm_model.py, instead of tweaking params by hand
+#configs from SEARCH_SPACE are trained in a pool of worker processes using successive halving: every config gets a small
+#number of boosting rounds, the best 1/eta of them by validation AUC move on to eta times as many rounds, and so on up to
+#max_rounds. A config that early stopped (early_stopping_round from lightgbm_model.params) has already converged, so its
+#result is carried up to the next rung instead of being trained again
+#each worker gets cores // processes threads so the workers don't oversubscribe the machine
+#the table of every trial, with its wall clock time, is written to hyperparam_search.csv
+
+import os
+import time
+import itertools
+import pandas as pd
+import lightgbm as lgb
+from concurrent.futures import ProcessPoolExecutor
+
+import lightgbm_model as lm
+
+#values tried for each parameter, every combination is one config
+SEARCH_SPACE = {
+    'num_leaves': [4, 8, 16, 31, 63],
+    'learning_rate': [0.005, 0.01, 0.03, 0.1],
+    'feature_fraction': [0.6, 0.8, 0.9, 1.0],
+}
+
+def search_configs(space=SEARCH_SPACE):
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+#the Datasets are loaded once per worker from the binary cache (see lightgbm_model.build_datasets) and reused for every trial
+_worker = {}
+
+def _init_worker(entry, threads):
+    train_data, test_data, _ = lm.load_cached_datasets(entry)
+    _worker.update(train_data=train_data, test_data=test_data, threads=threads)
+
+#trains one config for `rounds` rounds. Returns the config plus the best validation AUC, the round it was reached at,
+#whether early stopping ended the run and the wall clock time in seconds
+def run_trial(config, rounds):
+    params = dict(lm.params, verbose=-1, num_threads=_worker['threads'], **config)
+    start = time.perf_counter()
+    bst = lgb.train(params, _worker['train_data'], rounds, valid_sets=[_worker['test_data']])
+    wall_time = time.perf_counter() - start
+    #the returned booster is cut back to best_iteration either way, so whether early stopping fired is told from the
+    #patience: it did once that many rounds went by without the AUC improving, and more rounds wouldn't change anything
+    patience = params.get('early_stopping_round')
+    stopped_early = bool(patience) and rounds - bst.best_iteration >= patience
+    return dict(config, rounds=rounds, best_iteration=bst.best_iteration, auc=bst.best_score['valid_0']['auc'],
+                stopped_early=stopped_early, wall_time=round(wall_time, 3))
+
+#runs the search on a dataset of format specified in combine_snd_sfc.py and returns one row per trial
+#processes defaults to the number of cores (or the number of configs if that's lower)
+def successive_halving(path, configs=None, min_rounds=25, max_rounds=400, eta=3, processes=None, cache_dir="lgb_dataset_cache"):
+    configs = search_configs() if configs is None else configs
+    #builds the Dataset cache if it isn't there yet, the workers then only load it
+    lm.build_datasets(path, cache_dir=cache_dir)
+    entry = os.path.join(cache_dir, lm.dataset_cache_key(path))
+
+    cores = os.cpu_count() or 1
+    processes = min(processes or cores, len(configs))
+    threads = max(1, cores // processes)
+
+    trials = []
+    survivors = list(range(len(configs)))
+    finished = {} #config -> result of a run that stopped early, reused for every later rung
+    rounds = min_rounds
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(entry, threads)) as pool:
+        for rung in itertools.count():
+            pending = [i for i in survivors if i not in finished]
+            results = dict(zip(pending, pool.map(run_trial, [configs[i] for i in pending], [rounds] * len(pending))))
+            for i in survivors:
+                if i in results:
+                    trials.append(dict(results[i], config=i, rung=rung))
+                    if results[i]['stopped_early']:
+                        finished[i] = results[i]
+                else:
+                    trials.append(dict(finished[i], config=i, rung=rung, wall_time=0.0))
+
+            if rounds >= max_rounds or len(survivors) == 1:
+                break
+            #keep the best 1/eta for the next rung
+            scores = {i: (results[i] if i in results else finished[i])['auc'] for i in survivors}
+            survivors = sorted(survivors, key=lambda i: -scores[i])[:max(1, len(survivors) // eta)]
+            rounds = min(rounds * eta, max_rounds)
+
+    return pd.DataFrame(trials)
+
+def main():
+    #dataset of format specified in combine_snd_sfc.py
+    data_path = os.path.join('.', 'ultimate_dataset2.csv')
+
+    start = time.perf_counter()
+    trials = successive_halving(data_path)
+    trials.to_csv("hyperparam_search.csv", index=False)
+
+    #the winners are the configs that made it to the last rung, best first
+    last = trials[trials['rung'] == trials['rung'].max()].sort_values('auc', ascending=False)
+    print(last.to_string(index=False))
+    print(len(trials), "trials,", round(trials['wall_time'].sum(), 1), "s of training in", round(time.perf_counter() - start, 1), "s")
+    return 0
+
+if __name__=="__main__":
+    main()
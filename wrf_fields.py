@@ -0,0 +1,101 @@
+#reads the fields wrf_precip.py needs straight from raw WRF output, for a window of the grid only
+#getvar('tc')/('td') work out the diagnostics for every point and level of the domain before they can be sliced, so on a
+#continental run most of the time and memory goes to points that are thrown away. Here only the window's hyperslab of the
+#raw fields (P+PB, T, QVAPOR, T2, Q2, PSFC) is read from the file, only the levels up to the first one that is above the
+#target pressure levels everywhere in the window, and tc/td are worked out from those, the same way wrf-python does
+
+import numpy as np
+
+#wrf-python's constants
+RD = 287.0
+CP = 1004.5
+P0 = 100000.0 #Pa, reference pressure of WRF's potential temperature
+EPS = 0.622
+#vapor pressure (hPa) floor before taking the log for the dewpoint
+MIN_VAPOR_PRESSURE = 0.001
+
+#the pressure levels (hPa) wrf_precip interpolates to
+TARGET_LEVELS = (925, 850)
+#levels of P/PB read at a time while looking for the top level needed
+LEVEL_CHUNK = 8
+
+#turns the corner grid points of a window (e.g. from ll_to_xy, in either order) into south_north and west_east slices,
+#kept inside a ny x nx grid
+def window_slices(x_start, x_end, y_start, y_end, ny, nx):
+    x0, x1 = sorted((int(x_start), int(x_end)))
+    y0, y1 = sorted((int(y_start), int(y_end)))
+    return slice(max(y0, 0), min(y1 + 1, ny)), slice(max(x0, 0), min(x1 + 1, nx))
+
+#one variable's hyperslab as doubles, fill values as NaN
+def _read(ncfile, name, *index):
+    return np.ma.filled(np.ma.asarray(ncfile.variables[name][index], dtype=np.float64), np.nan)
+
+#pressure (hPa) of the window from the lowest level up to the first level that is above top_pressure (hPa) at every
+#point, so any pressure down to top_pressure can be interpolated. Reads LEVEL_CHUNK levels at a time and stops there
+def read_pressure(ncfile, ys, xs, top_pressure=min(TARGET_LEVELS), time=0):
+    num_levels = ncfile.dimensions['bottom_top'].size
+    chunks = []
+    for start in range(0, num_levels, LEVEL_CHUNK):
+        stop = min(start + LEVEL_CHUNK, num_levels)
+        chunk = (_read(ncfile, 'P', time, slice(start, stop), ys, xs) + _read(ncfile, 'PB', time, slice(start, stop), ys, xs)) * 0.01
+        chunks.append(chunk)
+        above = np.flatnonzero((chunk < top_pressure).all(axis=(1, 2)))
+        if len(above):
+            chunks[-1] = chunk[:above[0] + 1]
+            break
+    return np.concatenate(chunks)
+
+#temperature (C) from WRF's perturbation potential temperature T (K) and pressure (hPa)
+def temperature_c(theta_perturbation, pressure):
+    return (theta_perturbation + 300.0) * (pressure * 100.0 / P0) ** (RD / CP) - 273.15
+
+#dewpoint (C) from the water vapor mixing ratio (kg/kg) and pressure (hPa), as wrf-python's td/td2
+def dewpoint_c(qv, pressure):
+    qv = np.maximum(qv, 0.0)
+    vapor_pressure = np.maximum(qv * pressure / (EPS + qv), MIN_VAPOR_PRESSURE)
+    log_e = np.log(vapor_pressure)
+    return (243.5 * log_e - 440.8) / (19.48 - log_e)
+
+#the window's fields, as float32 arrays. 'p', 'tc' and 'td' are (levels x ny x nx), only the levels needed to interpolate
+#down to the lowest pressure in levels, 'sfc_t', 'sfc_td', 'lat' and 'lon' are (ny x nx)
+def read_window(ncfile, ys, xs, levels=TARGET_LEVELS, time=0):
+    pressure = read_pressure(ncfile, ys, xs, min(levels), time)
+    vertical = slice(0, len(pressure))
+    fields = {
+        'p': pressure,
+        'tc': temperature_c(_read(ncfile, 'T', time, vertical, ys, xs), pressure),
+        'td': dewpoint_c(_read(ncfile, 'QVAPOR', time, vertical, ys, xs), pressure),
+        'sfc_t': _read(ncfile, 'T2', time, ys, xs) - 273.15,
+        'sfc_td': dewpoint_c(_read(ncfile, 'Q2', time, ys, xs), _read(ncfile, 'PSFC', time, ys, xs) * 0.01),
+        'lat': _read(ncfile, 'XLAT', time, ys, xs),
+        'lon': _read(ncfile, 'XLONG', time, ys, xs),
+    }
+    return {name: values.astype(np.float32) for name, values in fields.items()}
+
+#interpolates any number of (levels x ny x nx) fields to several pressure levels at once, linearly in log pressure, like
+#interplevel but with one pass over the pressure cube for all the targets and the weights shared by all the fields.
+#pressure decreases upward and is in the same units as targets. Returns a float32 (targets x fields x ny x nx) masked
+#array, masked (and NaN) where a target is below the ground (more than the lowest level's pressure) or above the top
+def interpolate_levels(pressure, fields, targets=TARGET_LEVELS):
+    pressure = np.asarray(pressure)
+    targets = np.asarray(targets, dtype=np.float64)[:, None, None]
+    num_levels = len(pressure)
+    #number of levels at or below each target, the target is between levels count-1 and count
+    count = np.zeros((len(targets),) + pressure.shape[1:], dtype=np.intp)
+    for level in pressure:
+        count += level >= targets
+    outside = (count == 0) | ((count == num_levels) & (pressure[-1] > targets))
+    lower = np.clip(count - 1, 0, max(num_levels - 2, 0))
+    upper = np.minimum(lower + 1, num_levels - 1)
+
+    log_lower = np.log(np.take_along_axis(pressure, lower, axis=0).astype(np.float64))
+    log_upper = np.log(np.take_along_axis(pressure, upper, axis=0).astype(np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(outside, np.nan, (np.log(targets) - log_lower) / (log_upper - log_lower))
+
+    result = np.empty((len(targets), len(fields)) + pressure.shape[1:], dtype=np.float32)
+    for i, field in enumerate(fields):
+        below = np.take_along_axis(field, lower, axis=0)
+        above = np.take_along_axis(field, upper, axis=0)
+        result[:, i] = below + weight * (above - below)
+    return np.ma.masked_array(result, mask=np.broadcast_to(outside[:, None], result.shape))
@@ -1,12 +1,14 @@
 #wrf-python apply precip-prediction to wrf output
 
 from netCDF4 import Dataset
-from wrf import getvar, to_np, latlon_coords, get_cartopy, ll_to_xy, interplevel
+from wrf import to_np, get_cartopy, ll_to_xy
 import numpy as np
 import matplotlib.pyplot as plt
 import cartopy.feature as cfeature
 import pandas as pd 
-import lightgbm as lgb
+from numpy_gbm import NumpyBooster
+from prediction_server import RemoteModel
+from wrf_fields import window_slices, read_window, interpolate_levels
 import matplotlib.colors as mcolors
 import cartopy.crs as ccrs
 
@@ -26,24 +28,29 @@ ne_xy = ll_to_xy(ncfile, ne_lat, ne_lon)
 x_start, x_end = int(sw_xy[0]), int(ne_xy[0])
 y_start, y_end = int(sw_xy[1]), int(ne_xy[1])
 
-#using the xy coordinates we obtained, slice the relevant variables
-pressure = getvar(ncfile, 'p').isel(south_north=slice(y_start, y_end + 1), west_east=slice(x_start, x_end + 1))
-temp_c = getvar(ncfile, 'tc').isel(south_north=slice(y_start, y_end + 1), west_east=slice(x_start, x_end + 1))
-temp_d = getvar(ncfile, 'td').isel(south_north=slice(y_start, y_end + 1), west_east=slice(x_start, x_end + 1))
-sfc_t = getvar(ncfile, 'T2').isel(south_north=slice(y_start, y_end + 1), west_east=slice(x_start, x_end + 1)) - 273.15
-sfc_td = getvar(ncfile, 'td2').isel(south_north=slice(y_start, y_end + 1), west_east=slice(x_start, x_end + 1))
+#using the xy coordinates we obtained, read only that window of the raw fields from the file (and only the levels up to
+#850 mb) and work out pressure (hPa), temperature and dewpoint (C) there, instead of getvar over the whole domain
+ys, xs = window_slices(x_start, x_end, y_start, y_end, ncfile.dimensions['south_north'].size, ncfile.dimensions['west_east'].size)
+window = read_window(ncfile, ys, xs, levels=(925, 850))
+pressure = window['p']
+temp_c = window['tc']
+temp_d = window['td']
+sfc_t = window['sfc_t']
+sfc_td = window['sfc_td']
 
 #extract the shape variables from wrf
 n_lev, n_lat, n_lon = pressure.shape
 
-#get these variables at 925 and 850 mb
+#get these variables at 925 and 850 mb, both levels and both fields in one go (levels x fields x ny x nx)
+#points where a level is below the ground come out as NaN
+upper_air = interpolate_levels(pressure, [temp_c, temp_d], (925, 850)).filled(np.nan)
 #925
-tc_925 = interplevel(temp_c, pressure, 925)
-td_925 = interplevel(temp_d, pressure, 925)
+tc_925 = upper_air[0, 0]
+td_925 = upper_air[0, 1]
 
 #850
-tc_850 = interplevel(temp_c, pressure, 850)
-td_850 = interplevel(temp_d, pressure, 850)
+tc_850 = upper_air[1, 0]
+td_850 = upper_air[1, 1]
 
 #once we have these, we can get them into a form that precip_predict can use, apply it to every point in the data. Find efficient way to do this
 #change each of these variables into 1d arrays that our ML model can use
@@ -59,8 +66,11 @@ data_dict = {
 #turn it into a pandas DF
 df_for_model = pd.DataFrame(data_dict)
 
-#load the ml model and then make predictions with each
-loaded_gbm = lgb.Booster(model_file='lightgbm_model_v1.txt')
+#load the ml model and then make predictions with each. NumpyBooster gives the same probabilities as lgb.Booster
+#without needing lightgbm, and is quicker on a full grid
+#set server_url to the address of a running prediction_server.py (e.g. 'http://127.0.0.1:8765') to use its model instead
+server_url = None
+loaded_gbm = RemoteModel(server_url) if server_url else NumpyBooster('lightgbm_model_v1.txt')
 probabilities = loaded_gbm.predict(df_for_model)
 
 #reshape to work on map of Midwest
@@ -68,8 +78,8 @@ ny, nx = sfc_t.shape
 pred_map = probabilities.reshape(ny, nx)
 
 #put all these values into an array associated with lat-lon coordinates that can then be plotted
-lats, lons = latlon_coords(sfc_td)
-cart_proj = get_cartopy(sfc_td)
+lats, lons = window['lat'], window['lon']
+cart_proj = get_cartopy(wrfin=ncfile)
 
 lon_min, lon_max = int(lats.min()), int(lons.max())
 